@@ -0,0 +1,117 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import traceback
+import multiprocessing
+from utils.Source_Scanner import scan_source_tree, list_study_folders
+from utils.Job_Journal import DEFAULT_JOURNAL_DIR, JobJournal, parse_shard, in_shard, scans_signature
+
+# Headless analysis of a whole study with AD_Assessment (or AD_Assessment_QC with --qc). Every finished folder is
+# written to a job journal, so a run that stopped resumes with the folders not done yet, and --shard i/n splits the
+# folders over several machines (or processes) sharing the study on one filesystem:
+#   python AD_Assessment_CLI.py /data/study --shard 0/2    (on one machine)
+#   python AD_Assessment_CLI.py /data/study --shard 1/2    (on another)
+# Settings not given on the command line come from the config files, like the batch scripts.
+
+
+def shard_arg(text):
+    try:
+        return parse_shard(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse every folder of a study, resuming where an earlier run "
+                                                 "stopped")
+    parser.add_argument('root', help="study root, with one folder of scans per subject")
+    parser.add_argument('--qc', action='store_true', help="also run the QC model (AD_Assessment_QC)")
+    parser.add_argument('--model', default=None, help="detection weights (default: config/model.ini)")
+    parser.add_argument('--conf', type=float, default=None, help="confidence threshold (default: config/model.ini)")
+    parser.add_argument('--preprocess-workers', type=int, default=None,
+                        help="preprocessing processes, 0 for all cores (default: config/pipeline.ini)")
+    parser.add_argument('--kde-workers', type=int, default=None,
+                        help="spatial analysis processes, 0 for all cores (default: config/pipeline.ini)")
+    parser.add_argument('--detect-batch', type=int, default=None,
+                        help="images per detection batch (default: config/pipeline.ini)")
+    parser.add_argument('--shard', type=shard_arg, default=(0, 1),
+                        help="analyse only shard i of n, e.g. 0/4 (default: all folders)")
+    parser.add_argument('--journal', default=None, help="journal directory (default: <root>/{}/<model>_<conf>)"
+                        .format(DEFAULT_JOURNAL_DIR))
+    parser.add_argument('--restart', action='store_true', help="analyse every folder again, ignoring the journal")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    root = os.path.abspath(args.root)
+    pipeline = importlib.import_module('AD_Assessment_QC' if args.qc else 'AD_Assessment')
+
+    model_path = pipeline.DETECTION_MODEL if args.model is None else args.model
+    model = os.path.basename(model_path)
+    conf = pipeline.CONF if args.conf is None else args.conf
+    workers = {name: value for name, value in (('preprocess_workers', args.preprocess_workers),
+                                               ('kde_workers', args.kde_workers),
+                                               ('detect_batch', args.detect_batch)) if value is not None}
+
+    # Folders of this shard whose scans were not analysed yet (or changed since)
+    manifest = scan_source_tree(root)
+    folders = [folder for folder in list_study_folders(root) if in_shard(folder, args.shard)]
+    journal_dir = args.journal or os.path.join(root, DEFAULT_JOURNAL_DIR, '{}_{}'.format(model, conf))
+    journal = JobJournal(journal_dir, args.shard)
+    signatures = {folder: scans_signature(manifest.get(folder, []), root) for folder in folders}
+    pending = [folder for folder in folders if args.restart or not journal.done(folder, signatures[folder])]
+    print("Shard {}/{}: {} folders, {} done earlier, {} to analyse".format(
+        args.shard[0], args.shard[1], len(folders), len(folders) - len(pending), len(pending)))
+    print("Journal", journal.path)
+
+    if not pending:
+        return 0
+    cno_model = pipeline.get_detector(model_path)
+    detection_cache = pipeline.DetectionCache(pipeline.DETECTION_CACHE, max_mb=pipeline.DETECTION_CACHE_MB)
+
+    # One pair of process pools for the whole run, shared by every folder
+    preprocess_executor = pipeline.process_pool(workers.get('preprocess_workers', pipeline.PREPROCESS_WORKERS))
+    kde_executor = pipeline.process_pool(workers.get('kde_workers', pipeline.KDE_WORKERS))
+
+    # A folder that fails is journaled and the run goes on; it is analysed again on the next run
+    failed = []
+    ti = time.time()
+    with preprocess_executor, kde_executor:
+        for i, folder in enumerate(pending):
+            print("\n[{}/{}] {}".format(i + 1, len(pending), folder))
+            start = time.time()
+            try:
+                file_list, failed_files = pipeline.process_folder(root, folder, manifest.get(folder, []), model,
+                                                                  conf, cno_model, detection_cache,
+                                                                  model_path=model_path,
+                                                                  preprocess_executor=preprocess_executor,
+                                                                  kde_executor=kde_executor, **workers)
+            except Exception as error:
+                traceback.print_exc()
+                journal.record(folder, 'failed', signatures[folder],
+                               error="{}: {}".format(type(error).__name__, error),
+                               seconds=round(time.time() - start, 2))
+                failed.append(folder)
+                continue
+            journal.record(folder, 'done', signatures[folder], files=list(file_list),
+                           failed_files=sorted(str(key) for key in failed_files),
+                           seconds=round(time.time() - start, 2))
+
+    if args.qc:
+        pipeline.release_predictor(pipeline.QC_PREDICTOR)
+
+    print("\nAnalysed {} folders in {:.2f} secs".format(len(pending) - len(failed), time.time() - ti))
+    if failed:
+        print("Failed folders ({}): {}".format(len(failed), ", ".join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv[1:]))
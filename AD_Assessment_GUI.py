@@ -4,15 +4,22 @@ import tkinter
 import tkinter.messagebox
 import customtkinter
 import pandas
-import threading
+import multiprocessing
 import glob
 from customtkinter import filedialog
 from utils.CNO_KDE_Integration import *
+from utils.Artifacts import artifact_path, render_artifacts
+from utils.Results_Store import DEFAULT_DATASET_DIR, load_results, wide_row
+from utils.Summary_Metrics import add_summary_metrics
+from utils.Analysis_Worker import AnalysisWorker
+from utils.Thumbnail_Cache import ThumbnailCache, PREFETCH_RADIUS
 
 customtkinter.set_appearance_mode("System")  # Modes: "System" (standard), "Dark", "Light"
 customtkinter.set_default_color_theme("green")  # Themes: "blue" (standard), "green", "dark-blue"
 IMAGE_WIDTH = 512
 IMAGE_HEIGHT = 512
+POLL_INTERVAL = 100  # Milliseconds between two polls of the analysis progress
+STAGE_NAMES = {'preprocess': "Preprocessing", 'detect': "Detection", 'kde': "KDE"}
 
 
 class App(customtkinter.CTk):
@@ -41,6 +48,12 @@ class App(customtkinter.CTk):
         self.path_btn.grid(row=2, column=0, padx=20, pady=10)
         self.start_btn = customtkinter.CTkButton(self.sidebar_frame, command=self.analyze_event, text="Analyze")
         self.start_btn.grid(row=3, column=0, padx=20, pady=10)
+        self.progress_frame = customtkinter.CTkFrame(self.sidebar_frame, fg_color="transparent")
+        self.progress_frame.grid(row=4, column=0, padx=20, pady=10, sticky="new")
+        self.progress_label = customtkinter.CTkLabel(self.progress_frame, text="")
+        self.progress_label.grid(row=0, column=0, sticky="ew")
+        self.progress_bar = customtkinter.CTkProgressBar(self.progress_frame, width=140)
+        self.progress_bar.set(0)
         self.appearance_mode_label = customtkinter.CTkLabel(self.sidebar_frame, text="Appearance Mode:", anchor="w")
         self.appearance_mode_label.grid(row=5, column=0, padx=20, pady=(10, 0))
         self.appearance_mode_optionemenu = customtkinter.CTkOptionMenu(self.sidebar_frame,
@@ -327,6 +340,10 @@ class App(customtkinter.CTk):
         # Initialize
         self.appearance_mode_optionemenu.set("System")
         self.scaling_optionemenu.set("100%")
+        self.worker = None
+        self.stop_btns = []
+        self.thumbnails = ThumbnailCache((IMAGE_WIDTH, IMAGE_HEIGHT))
+        self.protocol("WM_DELETE_WINDOW", self.close_event)
 
     def model_optionmenu_callback(self, choice: str):
         print("Model selected:", choice)
@@ -372,6 +389,9 @@ class App(customtkinter.CTk):
         self.scaling_val_label.configure(text=int(value))
 
     def analyze_event(self):
+        # One analysis at a time
+        if self.worker is not None and self.worker.running():
+            return
 
         # Retrieve User Input
         self.folder_dir = self.data_path_field.get()
@@ -453,16 +473,29 @@ class App(customtkinter.CTk):
         # self.conf = float(self.conf_optionmenu.get())
         print("Confidence Threshold: ", self.conf)
 
-        self.analyze_btn.grid_forget()
-        self.stop_btn.grid_forget()
+        # Hide Analyze and Stop buttons
+        for widget in self.button_frame_afm.winfo_children():
+            widget.grid_forget()
+        for widget in self.button_frame_cno.winfo_children():
+            widget.grid_forget()
+        for widget in self.button_frame_kde.winfo_children():
+            widget.grid_forget()
 
         self.afm_path = os.path.join(self.folder_dir, "CNO_Detection", "Image", "Enhanced")
         self.cno_path = os.path.join(self.folder_dir, "CNO_Detection", "Image", "KDE")
         self.csv_path = os.path.join(self.folder_dir, "CNO_Detection", "Result")
-
-        self.run_analyze = True
-
-        if os.path.exists(self.csv_path):
+        self.dataset_path = os.path.join(os.path.dirname(self.folder_dir), DEFAULT_DATASET_DIR)
+        self.folder_name = self.folder_dir.split(os.sep)[-1]
+        self.result_model = self.model  # The option menus stay usable while an analysis runs
+        self.result_conf = self.conf
+
+        # Results of this folder, model and threshold from the study dataset, else from a matching CSV
+        self.df = load_results(self.dataset_path, self.folder_name, self.model, self.conf)
+        self.run_analyze = self.df is None
+        if not self.run_analyze:
+            print("Read results", self.dataset_path)
+
+        if self.run_analyze and os.path.exists(self.csv_path):
             self.csv_files = os.listdir(self.csv_path)
 
             for i in range(len(self.csv_files)):
@@ -486,13 +519,16 @@ class App(customtkinter.CTk):
                                           font=customtkinter.CTkFont(size=16, weight="bold"))
             print("Analyzing...")
 
-            t1 = threading.Thread(target=cno_detect(self.folder_dir, self.model, self.conf))
+            self.start_analysis()
+            return
 
-            list_of_files = glob.glob(os.path.join(self.csv_path, '*.csv'))
-            latest_file = max(list_of_files, key=os.path.getmtime)
-            print("Read csv", latest_file)
-            self.df = pandas.read_csv(latest_file)
+        self.set_results(self.df)
+        self.image_view = 0
+        self.create_navigation()
+        self.show_image(self.image_view)
 
+    # New button frames with the Previous/Next buttons and result labels under the images
+    def create_navigation(self):
         self.button_frame_afm.grid_forget()
         self.button_frame_cno.grid_forget()
         self.button_frame_kde.grid_forget()
@@ -509,14 +545,6 @@ class App(customtkinter.CTk):
         self.button_frame_kde.grid(row=2, column=0, padx=80, pady=(0, 20), sticky="new")
         self.button_frame_kde.grid_columnconfigure((0, 1, 2), weight=1)
 
-        self.afm_files = [f for f in os.listdir(self.afm_path) if os.path.isfile(os.path.join(self.afm_path, f))]
-        self.cno_files = [f for f in os.listdir(self.cno_path) if
-                          os.path.isfile(os.path.join(self.cno_path, f)) and f.endswith("{}_{}_bbox.png".format(self.model, self.conf))]
-        self.kde_files = [f for f in os.listdir(self.cno_path) if
-                          os.path.isfile(os.path.join(self.cno_path, f)) and f.endswith("{}_{}_KDE.png".format(self.model, self.conf))]
-        self.image_num = len(self.afm_files)
-        self.image_view = 0
-
         # AFM Results
         self.result_label_afm = customtkinter.CTkLabel(self.button_frame_afm,
                                                        text=" ", font=customtkinter.CTkFont(size=16, weight="bold"))
@@ -558,7 +586,109 @@ class App(customtkinter.CTk):
         self.next_btn_kde = customtkinter.CTkButton(self.button_frame_kde, command=self.next_event, text="Next")
         self.next_btn_kde.grid(row=2, column=2, padx=10, sticky="new")
 
-        self.show_image(self.image_view)
+    # Image lists follow the result rows, so every image lines up with its results
+    def set_results(self, df):
+        self.df = add_summary_metrics(df)
+        image_names = [str(name) for name in self.df['File']]
+        self.afm_files = [name + '.png' for name in image_names]
+        self.cno_files = [os.path.basename(artifact_path(self.cno_path, name, self.result_model, self.result_conf,
+                                                         'bbox')) for name in image_names]
+        self.kde_files = [os.path.basename(artifact_path(self.cno_path, name, self.result_model, self.result_conf,
+                                                         'KDE')) for name in image_names]
+        self.image_num = len(self.afm_files)
+
+    # Run cno_detect on a background thread. poll_analysis() shows its progress and every image as soon as its
+    # results exist, so the window stays responsive and Stop cancels the analysis.
+    def start_analysis(self):
+        self.rows = []
+        self.progress_label.configure(text="Starting analysis", text_color=("gray10", "gray90"))
+        self.progress_bar.set(0)
+        self.progress_bar.grid(row=1, column=0, pady=(5, 0), sticky="ew")
+        self.show_stop_buttons()
+
+        self.worker = AnalysisWorker(cno_detect, (self.folder_dir, self.result_model, self.result_conf))
+        self.worker.start()
+        self.after(POLL_INTERVAL, self.poll_analysis)
+
+    def show_stop_buttons(self):
+        for button_frame in (self.button_frame_afm, self.button_frame_cno, self.button_frame_kde):
+            stop_btn = customtkinter.CTkButton(button_frame, command=self.stop_event, text="Stop")
+            stop_btn.grid(row=3, column=0, padx=20, pady=(15, 0), columnspan=3)
+            self.stop_btns.append(stop_btn)
+
+    def poll_analysis(self):
+        for event in self.worker.poll():
+            if event['type'] == 'stage':
+                self.show_progress(event['stage'], event['done'], event['total'])
+            elif event['type'] == 'image':
+                self.add_result(event['index'], event['values'])
+            else:
+                self.finish_analysis(event)
+                return
+        self.after(POLL_INTERVAL, self.poll_analysis)
+
+    def show_progress(self, stage, done, total):
+        text = "{} {} / {}".format(STAGE_NAMES[stage], done, total)
+        self.progress_label.configure(text=text)
+        self.progress_bar.set(done / total if total else 0)
+        if not self.rows:
+            for img_result in (self.afm_img_result, self.cno_img_result, self.kde_img_result):
+                img_result.configure(text="Analyzing...Please wait.\n" + text)
+
+    # Show the results of one image as soon as they arrive
+    def add_result(self, index, values):
+        first = not self.rows
+        while len(self.rows) <= index:
+            self.rows.append({})
+        self.rows[index].update(wide_row(values))
+        self.set_results(pandas.DataFrame(self.rows))
+
+        if first:
+            self.image_view = 0
+            self.create_navigation()
+            self.show_stop_buttons()  # The navigation replaced the button frames
+            self.show_image(self.image_view)
+        else:
+            for image_label in (self.image_label_afm, self.image_label_cno, self.image_label_kde):
+                image_label.configure(text="{} / {}".format(self.image_view + 1, self.image_num))
+
+    def finish_analysis(self, event):
+        self.progress_bar.grid_forget()
+        for stop_btn in self.stop_btns:
+            stop_btn.destroy()
+        self.stop_btns = []
+
+        if event['type'] == 'cancelled':
+            self.progress_label.configure(text="Analysis stopped")
+            message, color = "Analysis stopped", ("gray10", "gray90")
+        elif event['type'] == 'error':
+            self.progress_label.configure(text="Analysis failed", text_color="red")
+            message, color = "Analysis failed\n" + event['message'], "red"
+        else:
+            self.progress_label.configure(text="Analysis finished")
+            self.df = load_results(self.dataset_path, self.folder_name, self.result_model, self.result_conf)
+            list_of_files = glob.glob(os.path.join(self.csv_path, '*.csv'))
+            if self.df is not None:
+                print("Read results", self.dataset_path)
+            else:
+                latest_file = max(list_of_files, key=os.path.getmtime)
+                print("Read csv", latest_file)
+                self.df = pandas.read_csv(latest_file)
+
+            if len(self.df) > 0:
+                self.set_results(self.df)
+                if not self.rows:
+                    self.image_view = 0
+                    self.create_navigation()
+                self.image_view = min(self.image_view, self.image_num - 1)
+                self.show_image(self.image_view)
+                return
+            message, color = "No images found", "red"
+
+        # Images analysed before the analysis stopped stay available
+        if not self.rows:
+            for img_result in (self.afm_img_result, self.cno_img_result, self.kde_img_result):
+                img_result.configure(text=message, text_color=color)
 
     def next_event(self):
         self.image_view += 1
@@ -574,75 +704,67 @@ class App(customtkinter.CTk):
         print(self.image_view)
         self.show_image(self.image_view)
 
+    # Stop cancels a running analysis, otherwise it closes the window
     def stop_event(self):
+        if self.worker is not None and self.worker.running():
+            self.worker.cancel()
+            self.progress_label.configure(text="Stopping...")
+            return
         self.destroy()
 
+    def close_event(self):
+        if self.worker is not None:
+            self.worker.cancel()
+        self.thumbnails.close()
+        self.destroy()
+
+    # Image of one result, or None when the analysis did not keep it (see the artifacts setting)
+    def load_image(self, path):
+        image = self.thumbnails.get(path)
+        if image is None:
+            return None
+        return customtkinter.CTkImage(light_image=image, size=(IMAGE_WIDTH, IMAGE_HEIGHT))
+
+    # Show an image in one of the image labels, which are reused for every image
+    def set_image(self, img_result, path):
+        image = self.load_image(path)
+        img_result.configure(image=image if image is not None else "",
+                             text='' if image is not None else 'Image not available')
+        return image
+
+    # Enhanced, bbox and KDE images of one result
+    def image_paths(self, image_view):
+        return (os.path.join(self.afm_path, self.afm_files[image_view]),
+                os.path.join(self.cno_path, self.cno_files[image_view]),
+                os.path.join(self.cno_path, self.kde_files[image_view]))
+
     def show_image(self, image_view):
 
+        # Figures of analyses that only kept the CNO coordinates are rendered the first time they are shown
+        render_artifacts(self.cno_path, self.afm_path, self.afm_files[image_view][:-len('.png')], self.result_model,
+                         self.result_conf)
+
         self.cno_count = self.df['CNO'][image_view]
 
-        self.kde_density = round((self.df['Layer_Density_16'][image_view] +
-                                  self.df['Layer_Density_17'][image_view] +
-                                  self.df['Layer_Density_18'][image_view]) / 3.0, 4)
+        self.kde_density = self.df['ECTI'][image_view]
+        self.area_cover = self.df['Area_Coverage'][image_view]
 
-        self.area_cover = round((self.df['Layer_Area_1'][image_view] +
-                                 self.df['Layer_Area_2'][image_view] +
-                                 self.df['Layer_Area_3'][image_view] +
-                                 self.df['Layer_Area_4'][image_view] +
-                                 self.df['Layer_Area_5'][image_view]) * 100 / (5 * 512 * 512), 2)
+        color = "green" if self.df['Pass'][image_view] else "red"
 
-        if self.cno_count <= 59 or self.area_cover < 90:
-            color = "red"
-        else:
-            color = "green"
-
-        self.afm_img_result.grid_forget()
-        self.afm_image = customtkinter.CTkImage(
-            light_image=Image.open(os.path.join(self.afm_path, self.afm_files[image_view])),
-            size=(IMAGE_WIDTH, IMAGE_HEIGHT))
-        self.afm_img_result = customtkinter.CTkLabel(master=self.tabview.tab("AFM"), image=self.afm_image, text='')
-        self.afm_img_result.grid(column=0, row=1, padx=20, pady=20, sticky="nsew")
-        self.result_label_afm = customtkinter.CTkLabel(self.button_frame_afm,
-                                                       text="CNO Count: {} | KDE Density: {} | Area: {} %".format(
-                                                            self.cno_count + 1, self.kde_density, self.area_cover),
-                                                       font=customtkinter.CTkFont(size=16, weight="bold"),
-                                                       text_color=color)
-        self.result_label_afm.grid(row=0, column=0, padx=0, pady=(0, 20), sticky="new", columnspan=3)
-        self.image_label_afm = customtkinter.CTkLabel(self.button_frame_afm,
-                                                      text="{} / {}".format(image_view + 1, self.image_num))
-        self.image_label_afm.grid(row=2, column=1, padx=10, sticky="new")
+        self.afm_image = self.set_image(self.afm_img_result, os.path.join(self.afm_path, self.afm_files[image_view]))
+        self.result_label_afm.configure(text="CNO Count: {} | KDE Density: {} | Area: {} %".format(
+            self.cno_count + 1, self.kde_density, self.area_cover), text_color=color)
+        self.image_label_afm.configure(text="{} / {}".format(image_view + 1, self.image_num))
 
-        self.cno_img_result.grid_forget()
-        self.cno_image = customtkinter.CTkImage(
-            light_image=Image.open(os.path.join(self.cno_path, self.cno_files[image_view])),
-            size=(IMAGE_WIDTH, IMAGE_HEIGHT))
-        self.cno_img_result = customtkinter.CTkLabel(master=self.tabview.tab("CNO"), image=self.cno_image, text='')
-        self.cno_img_result.grid(column=0, row=1, padx=20, pady=20, sticky="nsew")
-        self.result_label_cno = customtkinter.CTkLabel(self.button_frame_cno,
-                                                       text="CNO Count: {} | KDE Density: {} | Area: {} %".format(
-                                                            self.cno_count + 1, self.kde_density, self.area_cover),
-                                                       font=customtkinter.CTkFont(size=16, weight="bold"),
-                                                       text_color=color)
-        self.result_label_cno.grid(row=0, column=0, padx=0, pady=(0, 20), sticky="new", columnspan=3)
-        self.image_label_cno = customtkinter.CTkLabel(self.button_frame_cno,
-                                                      text="{} / {}".format(image_view + 1, self.image_num))
-        self.image_label_cno.grid(row=2, column=1, padx=10, sticky="new")
+        self.cno_image = self.set_image(self.cno_img_result, os.path.join(self.cno_path, self.cno_files[image_view]))
+        self.result_label_cno.configure(text="CNO Count: {} | KDE Density: {} | Area: {} %".format(
+            self.cno_count + 1, self.kde_density, self.area_cover), text_color=color)
+        self.image_label_cno.configure(text="{} / {}".format(image_view + 1, self.image_num))
 
-        self.kde_img_result.grid_forget()
-        self.kde_image = customtkinter.CTkImage(
-            light_image=Image.open(os.path.join(self.cno_path, self.kde_files[image_view])),
-            size=(IMAGE_WIDTH, IMAGE_HEIGHT))
-        self.kde_img_result = customtkinter.CTkLabel(master=self.tabview.tab("KDE"), image=self.kde_image, text='')
-        self.kde_img_result.grid(column=0, row=1, padx=20, pady=20, sticky="nsew")
-        self.result_label_kde = customtkinter.CTkLabel(self.button_frame_kde,
-                                                       text="CNO Count: {} | KDE Density: {} | Area: {} %".format(
-                                                            self.cno_count + 1, self.kde_density, self.area_cover),
-                                                       font=customtkinter.CTkFont(size=16, weight="bold"),
-                                                       text_color=color)
-        self.result_label_kde.grid(row=0, column=0, padx=0, pady=(0, 20), sticky="new", columnspan=3)
-        self.image_label_kde = customtkinter.CTkLabel(self.button_frame_kde,
-                                                      text="{} / {}".format(image_view + 1, self.image_num))
-        self.image_label_kde.grid(row=2, column=1, padx=10, sticky="new")
+        self.kde_image = self.set_image(self.kde_img_result, os.path.join(self.cno_path, self.kde_files[image_view]))
+        self.result_label_kde.configure(text="CNO Count: {} | KDE Density: {} | Area: {} %".format(
+            self.cno_count + 1, self.kde_density, self.area_cover), text_color=color)
+        self.image_label_kde.configure(text="{} / {}".format(image_view + 1, self.image_num))
 
 
         print(self.afm_files[image_view])
@@ -652,7 +774,12 @@ class App(customtkinter.CTk):
         print('KDE Density: ', self.kde_density)
         print('Area (%): ', self.area_cover)
 
+        # Decode the neighbouring images in the background, nearest first
+        neighbours = [image_view + side * step for step in range(1, PREFETCH_RADIUS + 1) for side in (1, -1)]
+        self.thumbnails.prefetch([path for i in neighbours if 0 <= i < self.image_num for path in self.image_paths(i)])
+
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Needed by the preprocessing process pool in frozen executables
     app = App()
     app.mainloop()
@@ -0,0 +1,229 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+# Offline CPU benchmark of the analysis stages on synthetic data.
+# Times preprocessing (load_im, nid_image, pyramid_contrast, treat_one_image), the spatial analysis (bandwidth search,
+# KDE grid, layer statistics), rendering and QC one by one, then the whole per-image chain, and writes the timings
+# as JSON so they can be compared between commits:
+#
+#     python -m benchmarks.Pipeline_Benchmark --images 8 --repeat 5
+#     python -m benchmarks.Pipeline_Benchmark --compare benchmarks/results/<earlier run>.json
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+from pathlib import Path
+from utils.Img_Preprocessing import load_im, nid_image, pyramid_contrast, treat_one_image, preprocessing_params
+from utils.Spatial_Analysis import LAYER_COUNT, select_bandwidth, kde_grid, layer_statistics, analyze_spatial
+from utils.Rendering import draw_boxes, save_kde_figure, save_spatial_figure
+from benchmarks.Synthetic_Data import write_bcr, nid_array, cno_points
+
+DIR_NAME = Path(os.path.dirname(__file__))
+RESULTS_DIR = os.path.join(DIR_NAME, 'results')
+POINT_COUNTS = (20, 60, 150, 400)  # CNOs per image of the point-set benchmarks
+IMAGE_SIZE = 512
+MAX_FOLDS = 7
+
+
+# Run a function repeat times and summarize its wall time in milliseconds
+def time_call(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'runs': repeat, 'min_ms': round(min(times), 3), 'median_ms': round(float(np.median(times)), 3),
+            'mean_ms': round(float(np.mean(times)), 3), 'max_ms': round(max(times), 3)}
+
+
+# Commit the benchmark ran on, with a '+dirty' suffix for uncommitted changes (None outside a git checkout)
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DIR_NAME, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=DIR_NAME,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+dirty' if dirty else '')
+
+
+def metadata(args):
+    return {'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': git_revision(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'images': args.images, 'repeat': args.repeat,
+            'point_counts': list(args.points), 'qc': not args.skip_qc,
+            'preprocessing': preprocessing_params()}
+
+
+# Preprocessing stages, on one synthetic .bcr file and one .nid-like array
+def benchmark_preprocessing(work_dir, repeat, stages):
+    bcr_path = write_bcr(os.path.join(work_dir, 'bench_trace.bcr'), IMAGE_SIZE, IMAGE_SIZE, seed=0)
+    z_axis = nid_array(IMAGE_SIZE, IMAGE_SIZE, seed=1)
+    im = load_im(bcr_path)
+
+    stages['load_im'] = time_call(lambda: load_im(bcr_path), repeat)
+    stages['nid_image'] = time_call(lambda: nid_image(z_axis), repeat)
+    stages['pyramid_contrast'] = time_call(lambda: pyramid_contrast(im), repeat)
+
+    original_dir = os.path.join(work_dir, 'Original')
+    enhanced_dir = os.path.join(work_dir, 'Enhanced')
+    os.makedirs(original_dir, exist_ok=True)
+    os.makedirs(enhanced_dir, exist_ok=True)
+    stages['treat_one_image'] = time_call(lambda: treat_one_image(bcr_path, original_dir, enhanced_dir, 'bcr'),
+                                          repeat)
+
+
+# Spatial analysis stages for every point-set size
+def benchmark_spatial(point_counts, repeat, stages):
+    shape = (IMAGE_SIZE, IMAGE_SIZE)
+    for n in point_counts:
+        points, _ = cno_points(n, shape, seed=n)
+        folds = min(n, MAX_FOLDS)
+        bandwidth = select_bandwidth(points, 'cv', folds=folds)
+        _, _, z = kde_grid(points, bandwidth, shape)
+        levels = np.linspace(0, z.max(), LAYER_COUNT + 1)
+
+        stages['select_bandwidth[n={}]'.format(n)] = time_call(lambda: select_bandwidth(points, 'cv', folds=folds),
+                                                               repeat)
+        stages['kde_grid[n={}]'.format(n)] = time_call(lambda: kde_grid(points, bandwidth, shape), repeat)
+        stages['layer_statistics[n={}]'.format(n)] = time_call(lambda: layer_statistics(z, n, levels), repeat)
+
+
+# Rendering of the bbox, KDE and Spatial figures of one image
+def benchmark_rendering(work_dir, repeat, stages):
+    shape = (IMAGE_SIZE, IMAGE_SIZE)
+    points, corners = cno_points(150, shape, seed=150)
+    spatial = analyze_spatial(points, shape)
+    image = np.full((IMAGE_SIZE, IMAGE_SIZE, 3), 128, np.uint8)
+
+    def render():
+        cv2.imwrite(os.path.join(work_dir, 'bench_bbox.png'), draw_boxes(image.copy(), corners))
+        save_kde_figure(os.path.join(work_dir, 'bench_KDE.png'), spatial['z'], spatial['levels'])
+        save_spatial_figure(os.path.join(work_dir, 'bench_Spatial.png'), points, spatial['z'].shape)
+
+    stages['render'] = time_call(render, repeat)
+
+
+# QC classification of the enhanced images. Without a checkpoint the model keeps its random initial weights,
+# which costs the same as the trained model and needs no download.
+def qc_predictor(work_dir, checkpoint):
+    import torch
+    from utils.QC_Predictor import ModelPredictor
+    if checkpoint is None:
+        checkpoint = os.path.join(work_dir, 'bench_qc.pth')
+        torch.save({}, checkpoint)
+    return ModelPredictor(checkpoint, model_name='RETFound_mae', num_classes=2, input_size=224, device='cpu')
+
+
+# The per-image chain of the batch scripts on n synthetic scans: preprocessing, spatial analysis and rendering per
+# image, then QC of the whole folder
+def benchmark_end_to_end(work_dir, images, point_count, repeat, predictor, stages):
+    shape = (IMAGE_SIZE, IMAGE_SIZE)
+    scan_dir = os.path.join(work_dir, 'scans')
+    original_dir = os.path.join(scan_dir, 'Original')
+    enhanced_dir = os.path.join(scan_dir, 'Enhanced')
+    kde_dir = os.path.join(scan_dir, 'KDE')
+    for directory in (original_dir, enhanced_dir, kde_dir):
+        os.makedirs(directory, exist_ok=True)
+    scans = [write_bcr(os.path.join(scan_dir, 'S{}_trace.bcr'.format(i)), IMAGE_SIZE, IMAGE_SIZE, seed=i)
+             for i in range(images)]
+    detections = [cno_points(point_count, shape, seed=1000 + i) for i in range(images)]
+
+    def run():
+        names = []
+        for scan, (points, corners) in zip(scans, detections):
+            name = treat_one_image(scan, original_dir, enhanced_dir, 'bcr')
+            spatial = analyze_spatial(points, shape)
+            image = cv2.imread(os.path.join(enhanced_dir, name + '.png'))
+            cv2.imwrite(os.path.join(kde_dir, name + '_bbox.png'), draw_boxes(image, corners))
+            save_kde_figure(os.path.join(kde_dir, name + '_KDE.png'), spatial['z'], spatial['levels'])
+            save_spatial_figure(os.path.join(kde_dir, name + '_Spatial.png'), points, spatial['z'].shape)
+            names.append(name)
+        if predictor is not None:
+            predictor.predict_batch([os.path.join(enhanced_dir, name + '.png') for name in names],
+                                    batch_size=images, num_workers=0)
+
+    stage = time_call(run, repeat)
+    stage['per_image_ms'] = round(stage['median_ms'] / images, 3)
+    stages['end_to_end[images={}]'.format(images)] = stage
+
+    if predictor is not None:
+        png_files = [os.path.join(enhanced_dir, 'S{}_trace.png'.format(i)) for i in range(images)]
+        stage = time_call(lambda: predictor.predict_batch(png_files, batch_size=images, num_workers=0), repeat)
+        stage['per_image_ms'] = round(stage['median_ms'] / images, 3)
+        stages['qc[images={}]'.format(images)] = stage
+
+
+def print_stages(stages):
+    print("\n{:<32}{:>12}{:>12}{:>12}".format('Stage', 'Min (ms)', 'Median', 'Max'))
+    for name, stage in stages.items():
+        print("{:<32}{:>12.2f}{:>12.2f}{:>12.2f}".format(name, stage['min_ms'], stage['median_ms'], stage['max_ms']))
+
+
+# Print the median of every stage against an earlier run (ratios above 1 are slowdowns)
+def print_comparison(stages, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    print("\nCompared with {} (commit {})".format(baseline_path, baseline['metadata'].get('commit')))
+    print("{:<32}{:>12}{:>12}{:>10}".format('Stage', 'Before (ms)', 'After', 'Ratio'))
+    for name, stage in stages.items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            continue
+        print("{:<32}{:>12.2f}{:>12.2f}{:>10.2f}".format(name, before['median_ms'], stage['median_ms'],
+                                                        stage['median_ms'] / before['median_ms']))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis stages on synthetic AFM scans")
+    parser.add_argument('--images', type=int, default=8, help="synthetic scans in the end-to-end run")
+    parser.add_argument('--points', type=int, nargs='+', default=POINT_COUNTS,
+                        help="CNOs per image of the spatial analysis benchmarks")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per stage")
+    parser.add_argument('--skip-qc', action='store_true', help="leave out the QC model")
+    parser.add_argument('--qc-checkpoint', default=None, help="QC checkpoint (default: random weights)")
+    parser.add_argument('--output', default=None, help="JSON file (default: benchmarks/results/<time>_<commit>.json)")
+    parser.add_argument('--compare', default=None, help="earlier JSON result to compare the medians with")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = {}
+    result = {'metadata': metadata(args), 'stages': stages}
+
+    with tempfile.TemporaryDirectory(prefix='cno_benchmark_') as work_dir:
+        print("Preprocessing")
+        benchmark_preprocessing(work_dir, args.repeat, stages)
+        print("Spatial analysis")
+        benchmark_spatial(args.points, args.repeat, stages)
+        print("Rendering")
+        benchmark_rendering(work_dir, args.repeat, stages)
+        predictor = None if args.skip_qc else qc_predictor(work_dir, args.qc_checkpoint)
+        print("End to end")
+        benchmark_end_to_end(work_dir, args.images, 150, args.repeat, predictor, stages)
+
+    print_stages(stages)
+    if args.compare is not None:
+        print_comparison(stages, args.compare)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, '{}_{}.json'.format(time.strftime("%Y%m%d-%H%M%S"),
+                                                               result['metadata']['commit'] or 'unknown'))
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=1)
+    print("\nSaved", output)
+    return result
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,59 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import numpy as np
+from utils.Img_Preprocessing import BCR_HEADER_SIZE, BCR_DTYPE
+
+# Synthetic inputs for the benchmarks: AFM height maps with CNO-like bumps, written as .bcr files or kept as
+# .nid-like Z-Axis arrays, and CNO coordinate sets. Everything is seeded, so runs are comparable between commits.
+
+
+# Height map of a corneocyte surface: Gaussian bumps of CNO size on a tilted background, plus a random offset per
+# scan line (the horizontal artifacts load_im removes) and white noise. Returns a (ypixels, xpixels) float array.
+def afm_surface(xpixels=512, ypixels=512, n_bumps=150, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:ypixels, 0:xpixels]
+    surface = 0.002 * x + 0.001 * y
+    for cx, cy, radius in zip(rng.uniform(0, xpixels, n_bumps), rng.uniform(0, ypixels, n_bumps),
+                              rng.uniform(3, 9, n_bumps)):
+        x0, x1 = int(max(cx - 3 * radius, 0)), int(min(cx + 3 * radius + 1, xpixels))
+        y0, y1 = int(max(cy - 3 * radius, 0)), int(min(cy + 3 * radius + 1, ypixels))
+        surface[y0:y1, x0:x1] += np.exp(-((x[y0:y1, x0:x1] - cx) ** 2 + (y[y0:y1, x0:x1] - cy) ** 2) /
+                                        (2 * radius ** 2))
+    surface += rng.normal(0, 0.3, ypixels)[:, None]  # Scan line offsets
+    surface += rng.normal(0, 0.05, surface.shape)
+    return surface
+
+
+# Write a synthetic .bcr file: a 2048-byte ASCII header with valid xpixels/ypixels fields followed by the
+# little-endian int16 payload
+def write_bcr(path, xpixels=512, ypixels=512, n_bumps=150, seed=0):
+    surface = afm_surface(xpixels, ypixels, n_bumps, seed)
+    surface = (surface - surface.min()) / (surface.max() - surface.min())
+    payload = np.rint(surface * 60000 - 30000).astype(BCR_DTYPE)
+
+    header = 'fileformat = bcrstm\nxpixels = {}\nypixels = {}\nxlength = 20000\nylength = 20000\n' \
+             'xunit = nm\nyunit = nm\nzunit = nm\n'.format(xpixels, ypixels)
+    with open(path, 'wb') as f:
+        f.write(header.encode('latin-1').ljust(BCR_HEADER_SIZE, b' '))
+        f.write(payload.tobytes())
+    return path
+
+
+# Z-Axis channel of a synthetic .nid scan (heights in meters, as NSFopen returns them)
+def nid_array(xpixels=512, ypixels=512, n_bumps=150, seed=0):
+    return afm_surface(xpixels, ypixels, n_bumps, seed) * 1e-8
+
+
+# CNO detections of one image: n centroids drawn around a few cluster centres and uniformly over the image, as
+# box_geometry returns them (integer centroids and int32 xyxy corners)
+def cno_points(n, shape=(512, 512), clusters=4, seed=0):
+    rng = np.random.default_rng(seed)
+    clustered = n // 2
+    centres = rng.uniform(64, min(shape) - 64, (clusters, 2))
+    points = np.concatenate([centres[rng.integers(0, clusters, clustered)] + rng.normal(0, 40, (clustered, 2)),
+                             rng.uniform(0, min(shape), (n - clustered, 2))])
+    points = np.clip(points, 0, np.array(shape[::-1]) - 1)
+
+    sizes = rng.uniform(6, 16, (n, 2))
+    corners = np.rint(np.concatenate([points - sizes / 2, points + sizes / 2], axis=1)).astype(np.int32)
+    return np.rint(points).astype(int), corners
@@ -26,8 +26,41 @@ def import_config_dict():
     config.read('config/qc.ini')
     config_dict.update(create_config_dict(config))
 
+    config.read('config/pipeline.ini')
+    config_dict.update(create_config_dict(config))
+
+    config.read('config/kde.ini')
+    config_dict.update(create_config_dict(config))
+
+    config.read('config/serving.ini')
+    config_dict.update(create_config_dict(config))
+
     config_dict['MODEL']['conf_threshold'] = \
         float(config_dict['MODEL']['conf_threshold'])
+    config_dict['QC']['batch_size'] = \
+        int(config_dict['QC']['batch_size'])
+    config_dict['PIPELINE']['preprocess_workers'] = \
+        int(config_dict['PIPELINE']['preprocess_workers'])
+    config_dict['PIPELINE']['detect_batch'] = \
+        int(config_dict['PIPELINE']['detect_batch'])
+    config_dict['PIPELINE']['detection_cache_mb'] = \
+        int(config_dict['PIPELINE']['detection_cache_mb'])
+    config_dict['PIPELINE']['kde_workers'] = \
+        int(config_dict['PIPELINE']['kde_workers'])
+    config_dict['PIPELINE']['queue_size'] = \
+        int(config_dict['PIPELINE']['queue_size'])
+    config_dict['SERVING']['max_batch'] = \
+        int(config_dict['SERVING']['max_batch'])
+    config_dict['SERVING']['batch_wait_ms'] = \
+        int(config_dict['SERVING']['batch_wait_ms'])
+    config_dict['SERVING']['concurrency_limit'] = \
+        int(config_dict['SERVING']['concurrency_limit'])
+    config_dict['SERVING']['max_queued'] = \
+        int(config_dict['SERVING']['max_queued'])
+    config_dict['SERVING']['handler_concurrency'] = \
+        int(config_dict['SERVING']['handler_concurrency'])
+    config_dict['SERVING']['queue_size'] = \
+        int(config_dict['SERVING']['queue_size'])
 
     return config_dict
 
@@ -0,0 +1,93 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import re
+import numpy as np
+import pytest
+from scipy import ndimage
+from utils.Img_Preprocessing import BCR_HEADER_SIZE, read_bcr, load_im
+
+
+# The .bcr decoder load_im used before read_bcr: one int.from_bytes call per pixel
+def legacy_read_bcr(fn):
+    f = open(fn, 'rb')
+    a = f.read()
+    f.close()
+    aa = str(a[:2048])
+    xpix = int(re.findall(r'xpixels\s?=\s?([0-9]*)', aa)[0])
+    ypix = int(re.findall(r'ypixels\s?=\s?([0-9]*)', aa)[0])
+    a = a[2048:]
+
+    words = [a[k * 2:k * 2 + 2] for k in range(xpix * ypix)]
+    arr = [int.from_bytes(words[k], byteorder='little', signed=True) for k in range(len(words))]
+    return np.array(arr).reshape((ypix, xpix))
+
+
+def legacy_load_im(fn):
+    im = legacy_read_bcr(fn)
+    im = (im.T - np.mean(im, axis=1) +
+          np.mean(ndimage.gaussian_filter(im, 10), axis=1)).T
+    im = im - np.min(im)
+    im = im / np.max(im)
+    return im
+
+
+def write_bcr(path, payload, xpixels, ypixels, header_extra=''):
+    header = 'fileformat = bcrstm\nxpixels = {}\nypixels = {}\n{}'.format(xpixels, ypixels, header_extra)
+    with open(path, 'wb') as f:
+        f.write(header.encode('latin-1').ljust(BCR_HEADER_SIZE, b' '))
+        f.write(np.asarray(payload, dtype='<i2').tobytes())
+    return str(path)
+
+
+# Payload covering the whole int16 range, negative values and the extremes included
+def payload(xpixels, ypixels, seed=0):
+    values = np.random.default_rng(seed).integers(-32768, 32768, (ypixels, xpixels))
+    values[0, :4] = (-32768, -1, 0, 32767)
+    return values
+
+
+@pytest.mark.parametrize('xpixels, ypixels', [(64, 64), (96, 48), (33, 71)])
+def test_read_bcr_matches_legacy_decoder(tmp_path, xpixels, ypixels):
+    values = payload(xpixels, ypixels)
+    fn = write_bcr(tmp_path / 'scan_trace.bcr', values, xpixels, ypixels)
+
+    im = read_bcr(fn)
+    assert im.shape == (ypixels, xpixels)
+    assert np.array_equal(im, legacy_read_bcr(fn))
+    assert np.array_equal(im, values)
+
+
+def test_load_im_matches_legacy_pipeline(tmp_path):
+    fn = write_bcr(tmp_path / 'scan_trace.bcr', payload(80, 64, seed=1), 80, 64)
+    legacy = legacy_load_im(fn)
+    im = load_im(fn)
+    assert im.dtype == legacy.dtype
+    assert np.array_equal(im, legacy)
+
+
+def test_read_bcr_ignores_trailing_bytes(tmp_path):
+    values = payload(16, 8)
+    fn = write_bcr(tmp_path / 'scan_trace.bcr', values, 16, 8)
+    with open(fn, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+    assert np.array_equal(read_bcr(fn), values)
+
+
+def test_read_bcr_rejects_short_payload(tmp_path):
+    fn = write_bcr(tmp_path / 'scan_trace.bcr', payload(16, 8)[:-1], 16, 8)
+    with pytest.raises(ValueError, match='payload has'):
+        read_bcr(fn)
+
+
+def test_read_bcr_rejects_truncated_header(tmp_path):
+    fn = tmp_path / 'scan_trace.bcr'
+    fn.write_bytes(b'xpixels = 16\nypixels = 8\n')
+    with pytest.raises(ValueError, match='shorter than'):
+        read_bcr(str(fn))
+
+
+def test_read_bcr_rejects_missing_dimension(tmp_path):
+    fn = tmp_path / 'scan_trace.bcr'
+    fn.write_bytes(b'xpixels = 16\n'.ljust(BCR_HEADER_SIZE, b' ') + bytes(16 * 8 * 2))
+    with pytest.raises(ValueError, match='ypixels'):
+        read_bcr(str(fn))
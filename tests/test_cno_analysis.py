@@ -0,0 +1,72 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import numpy as np
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+pytest.importorskip('ultralytics')  # utils.CNO_Analysis draws the boxes with utils.CNO_Detector
+from utils.Analysis_Worker import ProgressReporter
+from utils.Detection_Cache import Detections
+from utils.CNO_Analysis import MIN_KDE_CNO, SPATIAL_COLUMNS, analyze_image, collect_spatial, spatial_columns
+
+COUNTS = (40, 3, 0, 80, MIN_KDE_CNO)
+
+
+def detections(n, rng):
+    xy = rng.uniform(10, 500, (n, 2))
+    wh = rng.uniform(5, 20, (n, 2))
+    return Detections(np.concatenate([xy, wh], axis=1).astype(np.float32),
+                      np.concatenate([xy - wh / 2, xy + wh / 2], axis=1).astype(np.float32),
+                      rng.uniform(0.3, 1, n).astype(np.float32))
+
+
+@pytest.fixture
+def folder():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (512, 512, 3), dtype=np.uint8)
+    names = ['image_{}'.format(i) for i in range(len(COUNTS))]
+    return names, [('{}.png'.format(name), image, detections(n, rng)) for name, n in zip(names, COUNTS)]
+
+
+def same_values(a, b):
+    assert a.keys() == b.keys()
+    for key in a:
+        assert np.array_equal(a[key], b[key], equal_nan=True) if isinstance(a[key], np.ndarray) else \
+            (a[key] == b[key] or (np.isnan(a[key]) and np.isnan(b[key])))
+
+
+@pytest.mark.parametrize('artifacts', ['full', 'on-demand', 'metrics'])
+def test_collect_spatial_matches_per_image_analysis(folder, tmp_path, artifacts):
+    names, results = folder
+    for directory in ('folder', 'image'):
+        (tmp_path / directory).mkdir()
+    events = []
+    with ThreadPoolExecutor(2) as executor:
+        rows = collect_spatial(iter(results), names, str(tmp_path / 'folder'), 0.3, 'model', executor,
+                               artifacts=artifacts, reporter=ProgressReporter(events.append))
+    assert [values['name'] for values in rows] == names
+    assert [values['cno'] for values in rows] == list(COUNTS)
+
+    for values, (_, image, found) in zip(rows, results):
+        same_values(values, analyze_image(values['name'], image, found, str(tmp_path / 'image'), 0.3, 'model',
+                                          artifacts=artifacts))
+        if values['cno'] < MIN_KDE_CNO:
+            assert np.isnan(values['total_area']) and np.isnan(values['layer_density']).all()
+
+    # Both paths write the same artifacts
+    assert sorted(os.listdir(str(tmp_path / 'folder'))) == sorted(os.listdir(str(tmp_path / 'image')))
+
+    # Images are reported in file order, each after its detection
+    reported = [event['index'] for event in events if event['type'] == 'image']
+    assert reported == list(range(len(names)))
+    assert [event['done'] for event in events if event.get('stage') == 'kde'] == list(range(1, len(names) + 1))
+
+
+def test_spatial_columns(folder, tmp_path):
+    names, results = folder
+    rows = [analyze_image(name, image, found, str(tmp_path), 0.3, 'model', artifacts='metrics')
+            for name, (_, image, found) in zip(names, results)]
+    columns = spatial_columns(rows)
+    assert len(columns) == len(SPATIAL_COLUMNS)
+    assert columns[0] == list(COUNTS)
@@ -0,0 +1,59 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import math
+import numpy as np
+import pytest
+
+pytest.importorskip('ultralytics')  # utils.CNO_Detector loads the detectors with ultralytics
+torch = pytest.importorskip('torch')
+from utils.CNO_Detector import box_geometry
+from utils.CNO_Analysis import measure_image
+from utils.Detection_Cache import Detections
+
+
+# Stands in for the ultralytics Boxes of one result
+class Boxes:
+    def __init__(self, xyxy):
+        self.xyxy = torch.from_numpy(xyxy)
+        self.xywh = torch.cat([(self.xyxy[:, :2] + self.xyxy[:, 2:]) / 2, self.xyxy[:, 2:] - self.xyxy[:, :2]], 1)
+
+
+# The per-box loop the analysis used before box_geometry
+def per_box_geometry(boxes):
+    cno = len(boxes.xyxy)
+    cno_coor = np.empty([cno, 2], dtype=int)
+    corners = []
+    total_area = 0
+    for j in range(cno):
+        w = boxes.xywh[j][2]  # Width of bounding box
+        h = boxes.xywh[j][3]  # Height of bounding box
+        area = (math.pi * w * h / 4) * 20 * 20 / (512 * 512)  # Area calculation
+        total_area += area
+        cno_coor[j] = [round(boxes.xywh[j][0].item()), round(boxes.xywh[j][1].item())]
+        corners.append([round(value.item()) for value in boxes.xyxy[j]])
+    avg_area = total_area / cno
+    return cno_coor, np.array(corners), round(total_area.item(), 4), round(avg_area.item(), 4)
+
+
+def random_boxes(rng, n):
+    xy = rng.uniform(0, 500, (n, 2))
+    wh = rng.uniform(1, 30, (n, 2))
+    return np.concatenate([xy, xy + wh], axis=1).astype(np.float32)
+
+
+@pytest.mark.parametrize('seed, n', [(0, 5), (1, 37), (2, 400), (3, 1200)])
+def test_box_geometry_matches_per_box_loop(seed, n):
+    boxes = Boxes(random_boxes(np.random.default_rng(seed), n))
+    cno_coor, corners, total_area, avg_area = per_box_geometry(boxes)
+
+    centroids, xyxy, areas = box_geometry(boxes)
+    assert areas.dtype == np.float32
+    assert np.array_equal(centroids, cno_coor)
+    assert np.array_equal(xyxy, corners)
+
+    # The totals are rounded from float32 sums, as the CSV has always stored them
+    detections = Detections(boxes.xywh.numpy(), boxes.xyxy.numpy(), np.ones(n, np.float32))
+    values = measure_image('image', None, detections, None, 0.3, 'model', artifacts='metrics')
+    assert values['total_area'] == total_area
+    assert values['avg_area'] == avg_area
+    assert values['cno'] == n
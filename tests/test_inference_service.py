@@ -0,0 +1,71 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('ultralytics')  # utils.Inference_Service loads the detectors through utils.CNO_Detector
+from utils import Inference_Service
+from utils.Inference_Service import InferenceService, ServiceBusy, TooManyImages
+
+
+# Stands in for a YOLO model: returns the value of every image as its result, and blocks until released once started
+class FakeDetector:
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.batches = []
+
+    def predict(self, images, conf, iou, verbose, **kwargs):
+        self.batches.append(len(images))
+        self.started.set()
+        self.release.wait(5)
+        return [int(image[0, 0, 0]) for image in images]
+
+
+@pytest.fixture
+def detector(monkeypatch):
+    detector = FakeDetector()
+    monkeypatch.setattr(Inference_Service, 'get_detector', lambda model_path: detector)
+    return detector
+
+
+@pytest.fixture
+def service(detector):
+    service = InferenceService({'YOLOv10-N': 'yolov10n.pt'}, max_batch=2, batch_wait=0, max_queued=4)
+    yield service
+    detector.release.set()
+    service.close()
+
+
+def images(*values):
+    return [np.full((4, 4, 3), value, dtype=np.uint8) for value in values]
+
+
+def test_results_in_image_order(service, detector):
+    detector.release.set()
+    assert service.submit('YOLOv10-N', images(1, 2, 3), 0.25, 0.5).result(5) == [1, 2, 3]
+    assert max(detector.batches) <= 2
+
+
+def test_too_many_images_on_first_request(service):
+    with pytest.raises(TooManyImages, match=r'max 4'):
+        service.submit('YOLOv10-N', images(*range(5)), 0.25, 0.5)
+    assert service.queue_sizes() == {}
+
+
+def test_busy_when_queue_is_full(service, detector):
+    running = service.submit('YOLOv10-N', images(1, 2), 0.25, 0.5)
+    assert detector.started.wait(5)  # Both images are in the blocked YOLO call, none is waiting
+    waiting = service.submit('YOLOv10-N', images(3, 4, 5, 6), 0.25, 0.5)
+    with pytest.raises(ServiceBusy, match='4 images are waiting for YOLOv10-N'):
+        service.submit('YOLOv10-N', images(7), 0.25, 0.5)
+
+    detector.release.set()
+    assert running.result(5) == [1, 2]
+    assert waiting.result(5) == [3, 4, 5, 6]
+
+
+def test_unknown_model(service):
+    with pytest.raises(KeyError):
+        service.submit('YOLOv99', images(1), 0.25, 0.5)
@@ -0,0 +1,138 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import shutil
+import pytest
+from benchmarks.Synthetic_Data import write_bcr
+from utils.Source_Scanner import ScanEntry, scan_source_tree
+from utils.Img_Preprocessing import preprocess_files, process_pool
+from utils.Preprocessing_Cache import MANIFEST_NAME, load_manifest, update_preprocessing
+from utils.Artifacts import discard_images
+
+
+@pytest.fixture
+def study(tmp_path):
+    folder = tmp_path / 'study' / 'P01'
+    folder.mkdir(parents=True)
+    for seed, name in enumerate(('a_trace.bcr', 'b_trace.bcr')):
+        write_bcr(str(folder / name), 64, 64, n_bumps=4, seed=seed)
+    return tmp_path / 'study'
+
+
+def scan_entry(path):
+    stat = os.stat(path)
+    return ScanEntry(str(path), 'bcr', stat.st_size, stat.st_mtime)
+
+
+def output_dirs(folder):
+    image_dir = os.path.join(str(folder), 'CNO_Detection', 'Image')
+    return os.path.join(image_dir, 'Original'), os.path.join(image_dir, 'Enhanced')
+
+
+def preprocess(folder, scans):
+    original, enhanced = output_dirs(folder)
+    os.makedirs(original, exist_ok=True)
+    os.makedirs(enhanced, exist_ok=True)
+    return update_preprocessing(scans, original, enhanced, workers=1)
+
+
+def image_state(folder):
+    _, enhanced = output_dirs(folder)
+    return {name: os.stat(os.path.join(enhanced, name)).st_mtime_ns for name in sorted(os.listdir(enhanced))}
+
+
+def test_same_study_through_another_path_form(study, monkeypatch):
+    monkeypatch.chdir(study.parent)
+    relative = os.path.join('study', 'P01')
+    assert preprocess(relative, scan_source_tree('study')['P01']) == (['a_trace', 'b_trace'], {})
+    first = image_state(relative)
+
+    absolute = str(study / 'P01')
+    assert preprocess(absolute, scan_source_tree(str(study))['P01']) == (['a_trace', 'b_trace'], {})
+    assert image_state(absolute) == first  # Nothing preprocessed again, nothing evicted
+
+
+def test_moved_folder_keeps_its_entries(study, tmp_path):
+    preprocess(study / 'P01', scan_source_tree(str(study))['P01'])
+    first = image_state(study / 'P01')
+
+    moved = tmp_path / 'moved'
+    shutil.move(str(study), str(moved))
+    assert preprocess(moved / 'P01', scan_source_tree(str(moved))['P01']) == (['a_trace', 'b_trace'], {})
+    assert image_state(moved / 'P01') == first
+
+
+def test_current_outputs_survive_eviction_of_old_entries(study):
+    folder = study / 'P01'
+    preprocess(folder, [scan_entry(folder / 'a_trace.bcr'), scan_entry(folder / 'b_trace.bcr')])
+
+    # a_trace.bcr moves to a subdirectory (a new entry producing the old image name) and b_trace.bcr is deleted
+    (folder / 'raw').mkdir()
+    os.replace(str(folder / 'a_trace.bcr'), str(folder / 'raw' / 'a_trace.bcr'))
+    os.remove(str(folder / 'b_trace.bcr'))
+    assert preprocess(folder, [scan_entry(folder / 'raw' / 'a_trace.bcr')]) == (['a_trace'], {})
+
+    original, enhanced = output_dirs(folder)
+    assert sorted(os.listdir(enhanced)) == ['a_trace.png']
+    assert sorted(os.listdir(original)) == ['a_trace.png']
+
+
+def test_changed_scan_is_preprocessed_again(study):
+    folder = study / 'P01'
+    preprocess(folder, scan_source_tree(str(study))['P01'])
+    first = image_state(folder)
+
+    write_bcr(str(folder / 'b_trace.bcr'), 64, 64, n_bumps=4, seed=7)
+    os.utime(str(folder / 'b_trace.bcr'), ns=(0, 10 ** 9))  # Make sure the size/mtime check sees the change
+    assert preprocess(folder, scan_source_tree(str(study))['P01']) == (['a_trace', 'b_trace'], {})
+    state = image_state(folder)
+    assert state['a_trace.png'] == first['a_trace.png']
+    assert sorted(state) == ['a_trace.png', 'b_trace.png']
+
+
+def test_discarded_images_are_preprocessed_again(study):
+    folder = study / 'P01'
+    file_list, _ = preprocess(folder, scan_source_tree(str(study))['P01'])
+    _, enhanced = output_dirs(folder)
+    discard_images(enhanced, file_list)  # What the 'none' artifact policy does after every folder
+    assert load_manifest(os.path.join(os.path.dirname(enhanced), MANIFEST_NAME)) == {}
+
+    assert preprocess(folder, scan_source_tree(str(study))['P01']) == (['a_trace', 'b_trace'], {})
+    assert sorted(os.listdir(enhanced)) == ['a_trace.png', 'b_trace.png']
+
+
+def test_missing_images_are_not_reported_as_cached(study):
+    folder = study / 'P01'
+    preprocess(folder, scan_source_tree(str(study))['P01'])
+    _, enhanced = output_dirs(folder)
+    os.remove(os.path.join(enhanced, 'a_trace.png'))  # Removed without updating the manifest
+
+    assert preprocess(folder, scan_source_tree(str(study))['P01']) == (['a_trace', 'b_trace'], {})
+    assert sorted(os.listdir(enhanced)) == ['a_trace.png', 'b_trace.png']
+
+
+def test_spawned_workers_match_inline_preprocessing(study, tmp_path):
+    files = [str(study / 'P01' / name) for name in ('a_trace.bcr', 'b_trace.bcr')]
+    images = {}
+    for workers in (1, 2):
+        enhanced = tmp_path / 'enhanced_{}'.format(workers)
+        enhanced.mkdir()
+        outputs, errors = preprocess_files(files, None, str(enhanced), workers=workers)
+        assert errors == {}
+        images[workers] = {name: (enhanced / name).read_bytes() for name in sorted(os.listdir(str(enhanced)))}
+        assert list(outputs.values()) == [['a_trace'], ['b_trace']]
+    assert images[1] == images[2]
+
+
+def test_run_pool_is_shared_by_the_folders(study, tmp_path):
+    scans = scan_source_tree(str(study))['P01']
+    images = {}
+    with process_pool(2) as executor:
+        for run in ('first', 'second'):
+            original, enhanced = tmp_path / run / 'Original', tmp_path / run / 'Enhanced'
+            original.mkdir(parents=True)
+            enhanced.mkdir()
+            outputs = update_preprocessing(scans, str(original), str(enhanced), executor=executor)
+            assert outputs == (['a_trace', 'b_trace'], {})  # The pool is still running for the second folder
+            images[run] = {name: (enhanced / name).read_bytes() for name in sorted(os.listdir(str(enhanced)))}
+    assert images['first'] == images['second']
@@ -0,0 +1,54 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage import morphology
+from benchmarks.Synthetic_Data import write_bcr
+from utils.Img_Preprocessing import DISK_RADII, PERCENTILES, PERCENTILE_BIT_DEPTH, load_im, disk_percentiles, \
+    pyramid_contrast, present
+
+# Tolerance of the enhanced PNGs at the default bit depth against the exact enhancement. The percentile maps are within
+# half a quantization step, but pyramid_contrast divides by the local range, so the 8-bit images differ by up to
+# 7-11/255 on these scans (mean below 0.7/255).
+PNG_MAX_ERROR = 12
+PNG_MEAN_ERROR = 1.0
+
+
+@pytest.fixture(scope='module', params=[0, 1, 2])
+def scan(request, tmp_path_factory):
+    fn = tmp_path_factory.mktemp('scans') / 'scan_{}.bcr'.format(request.param)
+    return load_im(str(write_bcr(str(fn), 128, 128, n_bumps=20, seed=request.param)))
+
+
+# The original filter of pyramid_contrast, before the rank filter path was added
+def legacy_percentiles(im, radius):
+    return [ndimage.percentile_filter(im, p, footprint=morphology.disk(radius)) for p in PERCENTILES]
+
+
+@pytest.mark.parametrize('radius', DISK_RADII)
+def test_exact_path_matches_ndimage(scan, radius):
+    for exact, legacy in zip(disk_percentiles(scan, radius, bit_depth=None), legacy_percentiles(scan, radius)):
+        assert np.array_equal(exact, legacy)
+
+
+@pytest.mark.parametrize('bit_depth', [8, 10])
+@pytest.mark.parametrize('radius', DISK_RADII)
+def test_quantized_percentiles_within_half_a_step(scan, radius, bit_depth):
+    step = 1 / (2 ** bit_depth - 1)
+    for quantized, legacy in zip(disk_percentiles(scan, radius, bit_depth=bit_depth), legacy_percentiles(scan, radius)):
+        assert quantized.shape == legacy.shape
+        assert np.abs(quantized - legacy).max() <= 0.5 * step + 1e-12
+
+
+def test_quantized_enhancement_within_tolerance(scan):
+    exact = np.asarray(present(scan, pyramid_contrast(scan, bit_depth=None))[1]).astype(int)
+    quantized = np.asarray(present(scan, pyramid_contrast(scan, bit_depth=PERCENTILE_BIT_DEPTH))[1]).astype(int)
+    error = np.abs(exact - quantized)
+    assert error.max() <= PNG_MAX_ERROR
+    assert error.mean() <= PNG_MEAN_ERROR
+
+
+def test_rejects_unsupported_bit_depth(scan):
+    with pytest.raises(ValueError, match='bit_depth'):
+        disk_percentiles(scan, DISK_RADII[0], bit_depth=16)
@@ -0,0 +1,34 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import numpy as np
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip('torch')
+QC_Predictor = pytest.importorskip('utils.QC_Predictor')  # Needs torchvision and timm for the RETFound model
+
+
+# A predictor with a small linear model in place of the RETFound checkpoint
+@pytest.fixture
+def predictor():
+    predictor = QC_Predictor.ModelPredictor.__new__(QC_Predictor.ModelPredictor)
+    predictor.input_size = 16
+    predictor.device = torch.device('cpu')
+    predictor.transform = predictor._build_transform()
+    torch.manual_seed(0)
+    predictor.model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(3 * 16 * 16, 2)).eval()
+    return predictor
+
+
+def test_spawned_loader_workers_match_inline_loading(predictor, tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(5):
+        paths.append(str(tmp_path / 'image_{}.png'.format(i)))
+        Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)).save(paths[-1])
+
+    inline = predictor.predict_batch(paths, batch_size=2, num_workers=0)
+    spawned = predictor.predict_batch(paths, batch_size=2, num_workers=2)
+    assert [result['filename'] for result in spawned] == [result['filename'] for result in inline]
+    assert np.array_equal(np.stack([result['probabilities'] for result in spawned]),
+                          np.stack([result['probabilities'] for result in inline]))
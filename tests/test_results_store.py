@@ -0,0 +1,37 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import csv
+import numpy as np
+import pytest
+from utils.Results_Store import csv_header, folder_results, write_csv
+
+# Columns of the CSV files written before the summary metrics, in their order
+LEGACY_HEADER = (['File', 'Country', 'Group', 'No.', 'TLSS', 'Lesional', 'CNO'] +
+                 ['Layer_Area_{}'.format(i) for i in range(25)] +
+                 ['Layer_CNO_{}'.format(i) for i in range(25)] +
+                 ['Layer_Density_{}'.format(i) for i in range(25)] +
+                 ['AVG_Area', 'AVG_Size'])
+LEGACY_QC_HEADER = LEGACY_HEADER[:7] + ['QC', 'QC_Conf'] + LEGACY_HEADER[7:]
+
+
+@pytest.mark.parametrize('qc, legacy', [(False, LEGACY_HEADER), (True, LEGACY_QC_HEADER)])
+def test_csv_header_keeps_the_legacy_columns(qc, legacy):
+    header = csv_header(qc)
+    assert header == legacy + ['ECTI', 'Area_Coverage', 'Pass']
+    assert len(header) == (89 if qc else 87)
+
+
+@pytest.mark.parametrize('qc', [False, True])
+def test_write_csv(tmp_path, qc):
+    layers = [np.arange(25, dtype=float), np.full(25, np.nan)]
+    results = folder_results(['a', 'b'], ('DK', '1', 3, 2, True), [40, 3], [12.5, np.nan], [0.3125, np.nan],
+                             layers, layers, layers, qc=['Pass', 'Fail'] if qc else None,
+                             qc_conf=[0.9, 0.8] if qc else None)
+    path = str(tmp_path / 'results.csv')
+    write_csv(path, results)
+    with open(path) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == csv_header(qc)
+    assert [len(row) for row in rows[1:]] == [len(rows[0])] * 2
+    assert [row[0] for row in rows[1:]] == ['a', 'b']
+    assert rows[1][rows[0].index('Layer_Area_24')] == '24.0'
@@ -0,0 +1,50 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import numpy as np
+import pytest
+from sklearn.model_selection import GridSearchCV, KFold
+from sklearn.neighbors import KernelDensity
+from benchmarks.Synthetic_Data import cno_points
+from utils.Spatial_Analysis import BANDWIDTHS, kde_grid, select_bandwidth
+
+
+# The bandwidth search of the analysis scripts before select_bandwidth
+def legacy_bandwidth(points, folds):
+    kde = KernelDensity(metric='euclidean', kernel='gaussian', algorithm='ball_tree')
+    gs = GridSearchCV(kde, {'bandwidth': BANDWIDTHS}, cv=KFold(folds))
+    return gs.fit(points).best_params_['bandwidth']
+
+
+# The KDE grid of the analysis scripts before kde_grid: one score_samples call over every pixel
+def legacy_kde_grid(points, bandwidth, shape):
+    kde = KernelDensity(metric='euclidean', kernel='gaussian', algorithm='ball_tree', bandwidth=bandwidth)
+    kde.fit(points)
+    xv, yv = np.meshgrid(np.arange(0, shape[0], 1), np.arange(0, shape[1], 1))
+    xys = np.vstack([xv.ravel(), yv.ravel()]).T
+    return xv, yv, np.exp(kde.score_samples(xys)).reshape(xv.shape)
+
+
+# Point counts include sets not divisible by the fold count and sets with fewer points than folds
+@pytest.mark.parametrize('n, seed', [(60, 0), (97, 1), (150, 2), (233, 3), (5, 4)])
+def test_cv_bandwidth_matches_grid_search(n, seed):
+    points, _ = cno_points(n, seed=seed)
+    folds = min(len(points), 7)
+    assert select_bandwidth(points, 'cv', folds=folds) == legacy_bandwidth(points, folds)
+
+
+@pytest.mark.parametrize('n, seed, bandwidth', [(60, 0, 20.0), (150, 2, 37.0), (233, 3, 60.0)])
+def test_kde_grid_matches_score_samples(n, seed, bandwidth):
+    shape = (200, 160)
+    points, _ = cno_points(n, shape=shape[::-1], seed=seed)
+    x, y, z = kde_grid(points, bandwidth, shape)
+    legacy_x, legacy_y, legacy_z = legacy_kde_grid(points, bandwidth, shape)
+
+    assert np.array_equal(x, legacy_x) and np.array_equal(y, legacy_y)
+    assert z.shape == legacy_z.shape
+    assert np.abs(z - legacy_z).max() <= 1e-12 * legacy_z.max()
+
+
+def test_unknown_bandwidth_method():
+    points, _ = cno_points(20)
+    with pytest.raises(ValueError, match='Unknown bandwidth method'):
+        select_bandwidth(points, 'median')
@@ -0,0 +1,45 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import pytest
+from PIL import Image
+from utils.Thumbnail_Cache import ThumbnailCache
+
+SIZE = (32, 32)
+
+
+@pytest.fixture
+def cache():
+    cache = ThumbnailCache(SIZE)
+    yield cache
+    cache.close()
+
+
+def write_png(path, colour):
+    Image.new('RGB', (64, 64), colour).save(path)
+    return str(path)
+
+
+def test_get_decodes_at_display_size(cache, tmp_path):
+    image = cache.get(write_png(tmp_path / 'image.png', (255, 0, 0)))
+    assert image.size == SIZE
+    assert image.getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_missing_file(cache, tmp_path):
+    assert cache.get(str(tmp_path / 'missing.png')) is None
+
+
+@pytest.mark.parametrize('prefetched', [False, True])
+def test_undecodable_file_is_not_cached(cache, tmp_path, prefetched):
+    path = str(tmp_path / 'image.png')
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')  # A figure that is still being written
+    if prefetched:
+        cache.prefetch([path])
+    assert cache.get(path) is None
+    assert not cache.images
+
+    write_png(path, (0, 255, 0))
+    os.utime(path, ns=(0, 10 ** 9))  # Make sure the key changes on file systems with coarse timestamps
+    assert cache.get(path).getpixel((0, 0)) == (0, 255, 0)
@@ -0,0 +1,81 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import queue
+import threading
+import traceback
+
+STAGES = ('preprocess', 'detect', 'kde', 'qc')
+
+
+# Raised inside an analysis when its cancel event is set
+class AnalysisCancelled(Exception):
+    pass
+
+
+# Progress events of one analysis, passed to callback as dicts:
+#   {'type': 'stage', 'stage': <one of STAGES>, 'done': n, 'total': m}
+#   {'type': 'image', 'index': i, 'values': {column: value}}  (results of image i, in file_list order)
+# Every stage event is also a cancellation point: once cancel (a threading.Event) is set, AnalysisCancelled is raised
+# in the analysis thread. Without a callback and cancel event the reporter does nothing.
+class ProgressReporter:
+    def __init__(self, callback=None, cancel=None):
+        self.callback = callback
+        self.cancel = cancel
+
+    def check(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise AnalysisCancelled()
+
+    def stage(self, stage, done, total):
+        self.check()
+        if self.callback is not None:
+            self.callback({'type': 'stage', 'stage': stage, 'done': done, 'total': total})
+
+    def image(self, index, **values):
+        if self.callback is not None:
+            self.callback({'type': 'image', 'index': index, 'values': values})
+
+
+# Run an analysis function (cno_detect) on a background thread. Its progress events go to a queue that the GUI
+# drains with poll() from an after() callback, so the Tk main loop never waits for the analysis.
+# The analysis starts its process pools from this thread, so they must spawn their workers (see process_pool).
+# The last event is {'type': 'done'}, {'type': 'cancelled'} or {'type': 'error', 'message': ...}.
+class AnalysisWorker:
+    def __init__(self, function, args=(), kwargs=None):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='analysis', daemon=True)
+
+    def _run(self):
+        try:
+            self.function(*self.args, progress=self.events.put, cancel=self.cancel_event, **self.kwargs)
+        except AnalysisCancelled:
+            print("Analysis cancelled")
+            self.events.put({'type': 'cancelled'})
+        except Exception as e:
+            traceback.print_exc()
+            self.events.put({'type': 'error', 'message': "{}: {}".format(type(e).__name__, e)})
+        else:
+            self.events.put({'type': 'done'})
+
+    def start(self):
+        self.thread.start()
+
+    # Ask the analysis to stop at its next cancellation point
+    def cancel(self):
+        self.cancel_event.set()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    # Events posted since the last call, oldest first
+    def poll(self):
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
@@ -0,0 +1,97 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import cv2
+import numpy as np
+from utils.Spatial_Analysis import LAYER_COUNT, kde_grid
+from utils.Preprocessing_Cache import forget_images
+from utils.Rendering import draw_boxes, save_kde_figure, save_spatial_figure
+
+# Which files an analysis leaves behind besides the CSV results:
+#   none       CSV only, the Enhanced images are removed once the folder is analysed (so they are preprocessed again
+#              on every run)
+#   metrics    CSV and the Enhanced images (detector input, reused by the preprocessing and detection caches)
+#   on-demand  metrics plus the CNO coordinates of every image; figures are rendered when asked for
+#   full       on-demand plus the Original images and the bbox/KDE/Spatial figures of every image
+ARTIFACT_POLICIES = ('none', 'metrics', 'on-demand', 'full')
+FIGURE_KINDS = ('bbox', 'KDE', 'Spatial')
+
+
+def check_artifact_policy(policy):
+    if policy not in ARTIFACT_POLICIES:
+        raise ValueError("Unknown artifact policy '{}', expected one of {}".format(policy, ARTIFACT_POLICIES))
+    return policy
+
+
+def keeps_original(policy):
+    return policy == 'full'
+
+
+def renders_figures(policy):
+    return policy == 'full'
+
+
+def saves_points(policy):
+    return policy in ('on-demand', 'full')
+
+
+# Path of one artifact of an image: a figure kind from FIGURE_KINDS, or 'points' for the saved coordinates
+def artifact_path(kde_dir, name, model_type, conf, kind):
+    extension = 'npz' if kind == 'points' else 'png'
+    return os.path.join(kde_dir, '{}_{}_{}_{}.{}'.format(name, model_type, conf, kind, extension))
+
+
+# Save what the figures of an image are drawn from: CNO centroids, box corners and the KDE bandwidth (NaN when
+# the image has too few CNOs for a KDE)
+def save_points(path, centroids, corners, bandwidth=np.nan):
+    np.savez_compressed(path, centroids=np.asarray(centroids), corners=np.asarray(corners, dtype=np.int32),
+                        bandwidth=np.float64(bandwidth))
+
+
+# Placeholder shown instead of the bbox and KDE figures of an image with too few CNOs
+def no_detection_image():
+    emp_img = np.zeros((512, 512, 3), np.uint8)
+    return cv2.putText(emp_img, 'No Detection', (160, 255), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255))
+
+
+# Render the bbox/KDE/Spatial figures of one image from its saved coordinates and Enhanced image.
+# Figures are kept when the bbox and KDE figures exist, unless overwrite=True. Returns {kind: path} of the figures,
+# or None when the image has no saved coordinates (analysed with the 'none' or 'metrics' policy).
+def render_artifacts(kde_dir, enhanced_png_path, name, model_type, conf, overwrite=False):
+    paths = {kind: artifact_path(kde_dir, name, model_type, conf, kind) for kind in FIGURE_KINDS}
+    if not overwrite and os.path.isfile(paths['bbox']) and os.path.isfile(paths['KDE']):
+        return paths
+
+    points_path = artifact_path(kde_dir, name, model_type, conf, 'points')
+    if not os.path.isfile(points_path):
+        return None
+    with np.load(points_path) as points:
+        centroids = points['centroids']
+        corners = points['corners']
+        bandwidth = float(points['bandwidth'])
+
+    if np.isnan(bandwidth):
+        cv2.imwrite(paths['bbox'], no_detection_image())
+        cv2.imwrite(paths['KDE'], no_detection_image())
+        del paths['Spatial']
+        return paths
+
+    bbox_img = cv2.imread(os.path.join(enhanced_png_path, name + '.png'))
+    cv2.imwrite(paths['bbox'], draw_boxes(bbox_img, corners))
+
+    _, _, z = kde_grid(centroids, bandwidth, bbox_img.shape[:2])
+    levels = np.linspace(0, z.max(), LAYER_COUNT + 1)
+    save_kde_figure(paths['KDE'], z, levels)
+    save_spatial_figure(paths['Spatial'], centroids, z.shape)
+    return paths
+
+
+# Remove the Enhanced images of a folder once its results are written ('none' policy), together with their
+# preprocessing manifest entries
+def discard_images(enhanced_png_path, file_list):
+    for name in file_list:
+        try:
+            os.remove(os.path.join(enhanced_png_path, name + '.png'))
+        except FileNotFoundError:
+            pass
+    forget_images(enhanced_png_path, file_list)
@@ -0,0 +1,145 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import cv2
+import numpy as np
+from utils.CNO_Detector import box_geometry
+from utils.Spatial_Analysis import LAYER_COUNT, analyze_spatial, print_spatial
+from utils.Rendering import draw_boxes, save_kde_figure, save_spatial_figure
+from utils.Artifacts import renders_figures, saves_points, artifact_path, save_points, no_detection_image
+from utils.Analysis_Worker import ProgressReporter
+
+# Analysis of the CNO detections of one folder, shared by the batch scripts, the staged pipeline and the GUIs.
+# Every image becomes a dict of its CSV values: name, cno, avg_area, total_area, layer_area, layer_cno, layer_density.
+MIN_KDE_CNO = 5  # Images with fewer CNOs get NaN areas and layers instead of a KDE
+SPATIAL_COLUMNS = ('cno', 'avg_area', 'total_area', 'layer_area', 'layer_cno', 'layer_density')
+
+
+# CNO count and box areas of one image, and its bounding box figure when the policy renders figures.
+# Returns the values of the image with its CNO centroids and box corners (None for images below MIN_KDE_CNO, which get
+# the 'No Detection' bbox and KDE figures when placeholders is set).
+def measure_image(name, bbox_img, detections, kde_dir, conf, model_type, artifacts='full', placeholders=False):
+    render = renders_figures(artifacts)
+    cno = len(detections.conf)
+    if cno < MIN_KDE_CNO:
+        if render and placeholders:
+            emp_img = no_detection_image()
+            cv2.imwrite(artifact_path(kde_dir, name, model_type, conf, 'bbox'), emp_img)
+            cv2.imwrite(artifact_path(kde_dir, name, model_type, conf, 'KDE'), emp_img)
+        return {'name': name, 'cno': cno, 'avg_area': np.nan, 'total_area': np.nan, 'coords': None, 'corners': None}
+
+    cno_coor, bbox_xyxy, areas = box_geometry(detections)
+    total_area = np.cumsum(areas)[-1]  # Sequential float32 sum, same value as accumulating box by box
+    avg_area = total_area / cno  # Calculate average area
+
+    # Save bounding box image
+    if render:
+        cv2.imwrite(artifact_path(kde_dir, name, model_type, conf, 'bbox'), draw_boxes(bbox_img, bbox_xyxy))
+
+    return {'name': name, 'cno': cno, 'avg_area': round(avg_area.item(), 4), 'total_area': round(total_area.item(), 4),
+            'coords': cno_coor, 'corners': bbox_xyxy}
+
+
+# Add the KDE layers of one image (spatial is its analyze_spatial result, None below MIN_KDE_CNO for NaN layers) to
+# the values from measure_image, then save its CNO coordinates and KDE/Spatial figures as the policy asks.
+# The coordinates are dropped from the values once saved.
+def store_spatial(values, spatial, kde_dir, conf, model_type, bandwidth_method='cv', artifacts='full'):
+    name = values['name']
+    cno_coor = values.pop('coords')
+    bbox_xyxy = values.pop('corners')
+    if spatial is None:
+        if saves_points(artifacts):
+            save_points(artifact_path(kde_dir, name, model_type, conf, 'points'),
+                        np.empty((0, 2), int), np.empty((0, 4), np.int32))
+        nan_arr = np.empty([LAYER_COUNT])
+        nan_arr[:] = np.nan
+        values.update(layer_area=nan_arr, layer_cno=nan_arr, layer_density=nan_arr)
+        return values
+
+    print_spatial(spatial, bandwidth_method)
+    values.update(layer_area=spatial['layer_area'], layer_cno=spatial['layer_cno'],
+                  layer_density=spatial['layer_density'])
+
+    # Keep what the figures are drawn from, so they can be rendered later
+    if saves_points(artifacts):
+        save_points(artifact_path(kde_dir, name, model_type, conf, 'points'), cno_coor, bbox_xyxy,
+                    spatial['bandwidth'])
+
+    # Plot CNO distribution
+    if renders_figures(artifacts):
+        save_kde_figure(artifact_path(kde_dir, name, model_type, conf, 'KDE'), spatial['z'], spatial['levels'])
+        save_spatial_figure(artifact_path(kde_dir, name, model_type, conf, 'Spatial'), cno_coor, spatial['z'].shape)
+    return values
+
+
+# Analyse the detections of one image in one go, with the spatial analysis on the executor when one is given
+def analyze_image(name, bbox_img, detections, kde_dir, conf, model_type, bandwidth_method='cv', executor=None,
+                  artifacts='full', placeholders=False):
+    values = measure_image(name, bbox_img, detections, kde_dir, conf, model_type, artifacts, placeholders)
+    spatial = None
+    if values['coords'] is not None:
+        args = (values['coords'], bbox_img.shape[:2], bandwidth_method)
+        keep_grid = renders_figures(artifacts)
+        if executor is None:
+            spatial = analyze_spatial(*args, keep_grid=keep_grid)
+        else:
+            spatial = executor.submit(analyze_spatial, *args, keep_grid=keep_grid).result()
+    return store_spatial(values, spatial, kde_dir, conf, model_type, bandwidth_method, artifacts)
+
+
+# Analyse the detections of a folder (detection_results yields (path, image, Detections) in file_list order, like
+# detect_cached). The spatial analysis of each image runs on the executor (a process pool) while the next images are
+# being detected; results are collected in file_list order as soon as they are ready.
+# The reporter gets the 'detect' and 'kde' stage events and the values of every collected image; when it raises
+# (a cancelled analysis), the spatial analyses not started yet are dropped. Returns the values of every image.
+def collect_spatial(detection_results, file_list, kde_dir, conf, model_type, executor, bandwidth_method='cv',
+                    artifacts='full', placeholders=False, reporter=None):
+    if reporter is None:
+        reporter = ProgressReporter()
+    keep_grid = renders_figures(artifacts)
+    rows = []
+    spatial_jobs = []
+
+    # Store the spatial analysis of one image and plot its CNO distribution
+    def collect(idx):
+        job = spatial_jobs[idx]
+        values = store_spatial(rows[idx], None if job is None else job.result(), kde_dir, conf, model_type,
+                               bandwidth_method, artifacts)
+        spatial_jobs[idx] = None  # Release the KDE grid once plotted
+        reporter.image(idx, File=values['name'], CNO=values['cno'], Layer_Area=values['layer_area'],
+                       Layer_CNO=values['layer_cno'], Layer_Density=values['layer_density'],
+                       AVG_Area=values['total_area'], AVG_Size=values['avg_area'])
+        reporter.stage('kde', idx + 1, len(file_list))
+
+    collected = 0
+    reporter.stage('detect', 0, len(file_list))
+    try:
+        for idx, (_, bbox_img, detections) in enumerate(detection_results):
+            values = measure_image(file_list[idx], bbox_img, detections, kde_dir, conf, model_type, artifacts,
+                                   placeholders)
+            rows.append(values)
+            if values['coords'] is None:
+                spatial_jobs.append(None)
+            else:
+                spatial_jobs.append(executor.submit(analyze_spatial, values['coords'], bbox_img.shape[:2],
+                                                    bandwidth_method, keep_grid=keep_grid))
+            reporter.stage('detect', idx + 1, len(file_list))
+
+            while collected < len(spatial_jobs) and (spatial_jobs[collected] is None or
+                                                     spatial_jobs[collected].done()):
+                collect(collected)
+                collected += 1
+
+        while collected < len(spatial_jobs):
+            collect(collected)
+            collected += 1
+    except BaseException:
+        for job in spatial_jobs:
+            if job is not None:
+                job.cancel()
+        raise
+    return rows
+
+
+# CSV columns of the analysed images, in SPATIAL_COLUMNS order
+def spatial_columns(rows):
+    return tuple([values[column] for values in rows] for column in SPATIAL_COLUMNS)
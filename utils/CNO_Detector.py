@@ -0,0 +1,91 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import cv2
+import threading
+import numpy as np
+from collections import OrderedDict
+from ultralytics import YOLO
+
+MAX_RESIDENT_DETECTORS = 2  # Number of YOLO models kept in memory at the same time
+
+# Process-wide registry of loaded detectors, ordered from least to most recently used
+_detectors = OrderedDict()
+_detectors_lock = threading.Lock()
+_max_resident = MAX_RESIDENT_DETECTORS
+
+
+# Return the shared YOLO detector for a weights file, loading it on first use.
+# When more than the configured number of models are resident, the least recently used one is evicted.
+def get_detector(model_path):
+    key = os.path.abspath(str(model_path))
+    with _detectors_lock:
+        detector = _detectors.get(key)
+        if detector is not None:
+            _detectors.move_to_end(key)
+            return detector
+
+        detector = YOLO(str(model_path))
+        _detectors[key] = detector
+        while len(_detectors) > _max_resident:
+            evicted, _ = _detectors.popitem(last=False)
+            print("Evicted detector", evicted)
+        return detector
+
+
+# Change how many detectors may stay resident, evicting the least recently used ones if needed
+def set_max_resident_detectors(max_resident):
+    global _max_resident
+    with _detectors_lock:
+        _max_resident = max(1, int(max_resident))
+        while len(_detectors) > _max_resident:
+            _detectors.popitem(last=False)
+
+
+# Load detectors ahead of the first request and run one dummy inference so the graph is set up
+def warmup_detectors(model_paths, imgsz=512):
+    blank = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    for model_path in model_paths:
+        detector = get_detector(model_path)
+        detector.predict(blank, imgsz=imgsz, verbose=False)
+        print("Warmed up detector", model_path)
+
+
+# Drop one detector (or all of them) from the registry
+def release_detectors(model_path=None):
+    with _detectors_lock:
+        if model_path is None:
+            released = len(_detectors)
+            _detectors.clear()
+        else:
+            released = int(_detectors.pop(os.path.abspath(str(model_path)), None) is not None)
+    return released
+
+
+# Run a detector over image files in fixed-size batches and yield (path, result) pairs as they are produced.
+# Images are decoded one batch at a time and handed to YOLO as a list of arrays (batched inference), so at most
+# one batch of decoded images and results is alive at any time, whatever the number of files.
+def detect_stream(detector, image_paths, batch_size=8, **predict_args):
+    image_paths = list(image_paths)
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        images = [cv2.imread(str(path)) for path in batch_paths]
+        for path, result in zip(batch_paths, detector.predict(images, stream=True, **predict_args)):
+            yield path, result
+
+
+# Copy a box tensor to host memory (arrays that are already on the host are used as they are)
+def _to_numpy(values):
+    return values.cpu().numpy() if hasattr(values, 'cpu') else np.asarray(values)
+
+
+# Extract the geometry of all boxes of one detection result with a single host transfer per tensor.
+# Accepts ultralytics Boxes or any object with xywh/xyxy arrays (e.g. cached detections).
+# Returns the rounded centroids, the rounded corner boxes and the ellipse area of every box (um^2, float32)
+def box_geometry(boxes):
+    xywh = _to_numpy(boxes.xywh)
+    xyxy = _to_numpy(boxes.xyxy)
+    centroids = np.rint(xywh[:, :2]).astype(int)
+    corners = np.rint(xyxy).astype(np.int32)
+    areas = (np.pi * xywh[:, 2] * xywh[:, 3] / 4) * 20 * 20 / (512 * 512)  # 20 x 20 um scan over 512 x 512 pixels
+    return centroids, corners, areas
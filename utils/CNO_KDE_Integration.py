@@ -2,15 +2,17 @@
 
 import time
 import sys
-import csv
 import cv2
-import math
-import matplotlib.pyplot as plt
 from pathlib import Path
 from utils.Img_Preprocessing import *
-from ultralytics import YOLO
-from sklearn.neighbors import KernelDensity
-from sklearn.model_selection import GridSearchCV
+from utils.Source_Scanner import scan_source_tree
+from utils.Preprocessing_Cache import update_preprocessing
+from utils.Results_Store import DEFAULT_DATASET_DIR, folder_results, write_csv, write_parquet
+from utils.Artifacts import keeps_original, discard_images
+from utils.CNO_Detector import get_detector
+from utils.CNO_Analysis import collect_spatial, spatial_columns
+from utils.Detection_Cache import DetectionCache, detect_cached
+from utils.Analysis_Worker import ProgressReporter
 
 warnings.filterwarnings('ignore')
 DIR_NAME = Path(os.path.dirname(__file__)).parent
@@ -25,6 +27,9 @@ DETECTION_MODEL_m = os.path.join(DIR_NAME, 'models', 'yolov10m.pt')
 DETECTION_MODEL_b = os.path.join(DIR_NAME, 'models', 'yolov10b.pt')
 DETECTION_MODEL_l = os.path.join(DIR_NAME, 'models', 'yolov10l.pt')
 DETECTION_MODEL_x = os.path.join(DIR_NAME, 'models', 'yolov10x.pt')
+DETECTION_MODELS = {'YOLOv10-N': DETECTION_MODEL_n, 'YOLOv10-S': DETECTION_MODEL_s, 'YOLOv10-M': DETECTION_MODEL_m,
+                    'YOLOv10-B': DETECTION_MODEL_b, 'YOLOv10-L': DETECTION_MODEL_l, 'YOLOv10-X': DETECTION_MODEL_x}
+DETECTION_CACHE = os.path.join(DIR_NAME, 'cache', 'detections')
 
 def numcat(arr):
     arr_size = arr.shape[0]
@@ -34,164 +39,31 @@ def numcat(arr):
     return arr_cat
 
 
-def cno_detection(source, kde_dir, conf, cno_model, file_list, model_type):
+def cno_detection(source, kde_dir, conf, cno_model, file_list, model_type, detect_batch=8, bandwidth_method='cv', detection_cache=None, model_path=None, kde_workers=None, artifacts='full', reporter=None, executor=None):
 
-    # Declare Parameters
-    cno_col = []
-    total_layer_area = []
-    total_layer_cno = []
-    total_layer_density = []
-    avg_area_col = []
-    total_area_col = []
-
-    detection_results = cno_model.predict(source, save=False, save_txt=False, iou=0.5, conf=conf, max_det=1200)
+    # Stream detections batch by batch, running the detector only for images missing from the detection cache
+    image_paths = [os.path.join(source, name + '.png') for name in file_list]
+    detection_results = detect_cached(cno_model, model_path, image_paths, detection_cache, batch_size=detect_batch,
+                                      save=False, save_txt=False, iou=0.5, conf=conf, max_det=1200)
 
     # CNO Analysis
-    for idx, result in enumerate(detection_results):
-        CNO = len(result.boxes)
-        single_layer_area = []
-        single_layer_cno = []
-        single_layer_density = []
-        total_area = 0
-        if CNO < 5:
-            avg_area_col.append(np.nan)
-            total_area_col.append(np.nan)
-            nan_arr = np.empty([25])
-            nan_arr[:] = np.nan
-            total_layer_area.append(nan_arr)
-            total_layer_cno.append(nan_arr)
-            total_layer_density.append(nan_arr)
-            emp_img = np.zeros((512, 512, 3), np.uint8)
-            emp_img = cv2.putText(emp_img, 'No Detection', (160,255), cv2.FONT_HERSHEY_SIMPLEX, 1, (255,255,255))
-            cv2.imwrite(os.path.join(kde_dir, '{}_{}_{}_bbox.png'.format(file_list[idx], model_type, conf)),
-                        emp_img)
-            cv2.imwrite(os.path.join(kde_dir, '{}_{}_{}_KDE.png'.format(file_list[idx], model_type, conf)),
-                        emp_img)
-
-        else:
-            CNO_coor = np.empty([CNO, 2], dtype=int)
-            for j in range(CNO):
-                w = result.boxes.xywh[j][2]
-                h = result.boxes.xywh[j][3]
-                area = (math.pi * w * h / 4) * 20 * 20 / (512 * 512)
-                total_area += area
-                bbox_img = result.orig_img
-                x = round(result.boxes.xywh[j][0].item())
-                y = round(result.boxes.xywh[j][1].item())
-
-                x1 = round(result.boxes.xyxy[j][0].item())
-                y1 = round(result.boxes.xyxy[j][1].item())
-                x2 = round(result.boxes.xyxy[j][2].item())
-                y2 = round(result.boxes.xyxy[j][3].item())
-
-                CNO_coor[j] = [x, y]
-                bbox_img = cv2.rectangle(bbox_img,
-                                         (x1, y1),
-                                         (x2, y2),
-                                         (0, 255, 0), 1)
-
-            avg_area = total_area / CNO
-            avg_area_col.append(round(avg_area.item(), 4))
-            total_area_col.append(round(total_area.item(), 4))
-
-            cv2.imwrite(os.path.join(kde_dir, '{}_{}_{}_bbox.png'.format(file_list[idx], model_type, conf)),
-                        bbox_img)
-
-            kde = KernelDensity(metric='euclidean', kernel='gaussian', algorithm='ball_tree')
-
-            # Finding Optimal Bandwidth
-            ti = time.time()
-            if CNO < 7:
-                fold = CNO
-            else:
-                fold = 7
-            gs = GridSearchCV(kde, {'bandwidth': np.linspace(20, 60, 41)}, cv=fold)
-            cv = gs.fit(CNO_coor)
-            bw = cv.best_params_['bandwidth']
-            tf = time.time()
-            print("Finding optimal bandwidth={:.2f} ({:n}-fold cross-validation): {:.2f} secs".format(bw, cv.cv,
-                                                                                                      (tf - ti)))
-            kde.bandwidth = bw
-            _ = kde.fit(CNO_coor)
-
-            xgrid = np.arange(0, bbox_img.shape[0], 1)
-            ygrid = np.arange(0, bbox_img.shape[1], 1)
-            xv, yv = np.meshgrid(xgrid, ygrid)
-            xys = np.vstack([xv.ravel(), yv.ravel()]).T
-            gdim = xv.shape
-            zi = np.arange(xys.shape[0])
-            zXY = xys
-            z = np.exp(kde.score_samples(zXY))
-            zg = -9999 + np.zeros(xys.shape[0])
-            zg[zi] = z
-
-            xyz = np.hstack((xys[:, :2], zg[:, None]))
-            x = xyz[:, 0].reshape(gdim)
-            y = xyz[:, 1].reshape(gdim)
-            z = xyz[:, 2].reshape(gdim)
-            levels = np.linspace(0, z.max(), 26)
-            print("levels", levels)
-
-            for j in range(len(levels) - 1):
-                # Identify the grid points in this layer
-                layer_mask = (z >= levels[j])
-                layer_area = np.sum(layer_mask)  # Number of grid points in this layer
-
-                # Sum the KDE values in this layer
-                layer_kde_sum = np.sum(z[layer_mask])
-
-                # Calculate the real density in this layer
-                if layer_area > 0:
-                    density = np.round(
-                        ((layer_kde_sum / np.sum(z)) * CNO_coor.shape[0] / layer_area) * 512 * 512 / 400, 4)
-                    layer_cno = np.round(layer_kde_sum / np.sum(z) * CNO_coor.shape[0], 2)
-                else:
-                    density = 0.0
-                    layer_cno = 0.0
-                print("Level {}: Area={}, CNO={}, density={}".format(j, layer_area, layer_cno, density))
-                single_layer_area.append(layer_area)
-                single_layer_cno.append(layer_cno)
-                single_layer_density.append(density)
-
-            total_layer_area.append(single_layer_area)
-            total_layer_cno.append(single_layer_cno)
-            total_layer_density.append(single_layer_density)
-
-            # Plot CNO Distribution
-            plt.contourf(x, y, z, levels=levels, cmap=plt.cm.bone)
-            plt.axis('off')
-            plt.gcf().set_size_inches(8, 8)
-            plt.gca().invert_yaxis()
-            plt.savefig(os.path.join(kde_dir, '{}_{}_{}_KDE.png'.format(file_list[idx], model_type, conf)),
-                        bbox_inches='tight', pad_inches=0)
-            plt.clf()
+    # Cancelling stops at the next image and drops the queued spatial analyses
+    with run_pool(executor, kde_workers) as executor:
+        rows = collect_spatial(detection_results, file_list, kde_dir, conf, model_type, executor, bandwidth_method,
+                               artifacts, placeholders=True, reporter=reporter)
+    return spatial_columns(rows)
 
-            plt.scatter(CNO_coor[:, 0], CNO_coor[:, 1], s=10)
-            plt.axis('off')
-            plt.gcf().set_size_inches(8, 8)
-            plt.gca().invert_yaxis()
-            plt.savefig(os.path.join(kde_dir, '{}_{}_{}_Spatial.png'.format(file_list[idx], model_type, conf)),
-                        bbox_inches='tight', pad_inches=0)
-            plt.clf()
-        cno_col.append(CNO)
 
-    return cno_col, avg_area_col, total_area_col, total_layer_area, total_layer_cno, total_layer_density
+# progress receives the ProgressReporter events of the analysis; setting cancel (a threading.Event) stops it
+# at the next image without writing results
+def cno_detect(folder_dir, model, conf, preprocess_workers=None, kde_workers=None, artifacts='full', progress=None,
+               cancel=None):
+    reporter = ProgressReporter(progress, cancel)
 
-
-def cno_detect(folder_dir, model, conf):
-
-    if model == 'YOLOv10-N':
-        CNO_model = YOLO(DETECTION_MODEL_n)
-    elif model == 'YOLOv10-S':
-        CNO_model = YOLO(DETECTION_MODEL_s)
-    elif model == 'YOLOv10-M':
-        CNO_model = YOLO(DETECTION_MODEL_m)
-    elif model == 'YOLOv10-B':
-        CNO_model = YOLO(DETECTION_MODEL_b)
-    elif model == 'YOLOv10-L':
-        CNO_model = YOLO(DETECTION_MODEL_l)
-    else:
-        CNO_model = YOLO(DETECTION_MODEL_x)
+    # Shared detector, loaded once and kept resident between analyses
+    model_path = DETECTION_MODELS.get(model, DETECTION_MODEL_x)
+    CNO_model = get_detector(model_path)
+    detection_cache = DetectionCache(DETECTION_CACHE)
 
     # Search folder path
     folder = folder_dir.split(os.sep)[-1]
@@ -220,7 +92,6 @@ def cno_detect(folder_dir, model, conf):
     except (IndexError, TypeError):
         print("Invalid structure or data.")
 
-    run_preprocessing = True
     timestr = time.strftime("%Y%m%d-%H%M%S")
 
     CNO_list = []
@@ -236,58 +107,29 @@ def cno_detect(folder_dir, model, conf):
     save_dir = os.path.join(folder_dir, "CNO_Detection", "Result")
     print("Save Path:", save_dir)
 
+    if not keeps_original(artifacts):
+        original_png_path = None
+
     try:
-        os.makedirs(original_png_path, exist_ok=True)
+        if original_png_path is not None:
+            os.makedirs(original_png_path, exist_ok=True)
         os.makedirs(enhanced_png_path, exist_ok=True)
         os.makedirs(kde_png_path, exist_ok=True)
-        if not os.listdir(enhanced_png_path):
-            print("Directory is empty")
-            run_preprocessing = True
-        else:
-            print("Directory is not empty")
-            run_preprocessing = False
         os.makedirs(save_dir, exist_ok=True)
     except OSError as error:
         print("Directory can not be created")
 
-    encyc = []
-    walk = os.walk(folder_dir)
-    for d, sd, files in walk:
-        directory = d.split(os.sep)[-1]
-        for fn in files:
-            if (fn[0:2] != "._" and
-                    (fn.lower().endswith('_trace.bcr') or fn.lower().endswith('_retrace.bcr')) and directory == folder):
-                encyc.append(d + os.sep + fn)
-                file_type = "bcr"
-            elif fn[0:2] != "._" and fn[-3:].lower() == 'nid' and directory == folder:
-                encyc.append(d + os.sep + fn)
-                file_type = "nid"
-
-    encyc.sort()
+    # Index the scans of the folder in one pass
+    scans = scan_source_tree(folder_dir).get(folder, [])
+    encyc = [scan.path for scan in scans]
 
-    if run_preprocessing:
-        for i, fn in enumerate(encyc):
-            file_type = "bcr" if fn.lower().endswith(('.bcr')) else "nid"
-            file = treat_one_image(fn, original_png_path, enhanced_png_path, file_type)
-            if file_type == 'nid':
-                file_list.extend(file)
-            else:
-                file_list.append(file)
-            print(i, end=' ')
-    else:
-        for i, fn in enumerate(encyc):
-            file_type = "bcr" if fn.lower().endswith(('.bcr')) else "nid"
-            base = os.path.split(fn)[1][0:-10]
-            if file_type == 'nid':
-                # For .nid, add names based on direction
-                if "_OB" in fn:
-                    file_list.append(f"{base}_backward")
-                elif "_OF" in fn:
-                    file_list.append(f"{base}_forward")
-                else:
-                    file_list.extend([f"{base}_backward", f"{base}_forward"])
-            else:
-                file_list.append(base)
+    # Image preprocessing, reusing the cached images of unchanged scans
+    file_list, failed_files = update_preprocessing(scans, original_png_path, enhanced_png_path,
+                                                   workers=preprocess_workers,
+                                                   progress=lambda done, total: reporter.stage('preprocess', done,
+                                                                                               total))
+    if failed_files:
+        print("\nPreprocessing failed for {} file(s)".format(len(failed_files)))
 
     # CNO Detection & AD Classification
     print("Model", model)
@@ -297,7 +139,10 @@ def cno_detect(folder_dir, model, conf):
     cno_col, avg_area_col, total_area_col, layer_area, layer_cno, layer_density = cno_detection(enhanced_png_path,
                                                                                                 kde_png_path,
                                                                                                 conf, CNO_model,
-                                                                                                file_list, model)
+                                                                                                file_list, model,
+                                                                                                detection_cache=detection_cache, model_path=model_path,
+                                                                                                kde_workers=kde_workers, artifacts=artifacts,
+                                                                                                reporter=reporter)
     CNO_list.append(cno_col)
     Area_sum.append(total_area_col)
     Area_avg.append(avg_area_col)
@@ -306,61 +151,13 @@ def cno_detect(folder_dir, model, conf):
     Layer_cno = layer_cno
     Layer_density = layer_density
 
-    # Write CSV
-    # open the file in the write mode
-    f = open(save_dir + os.sep + '{}_{}_{}_{}_.csv'.format(folder, timestr, model, conf), 'w')
-    header = ['File', 'Country', 'Group', 'No.', 'TLSS', 'Lesional', 'CNO',
-
-              'Layer_Area_0', 'Layer_Area_1', 'Layer_Area_2', 'Layer_Area_3', 'Layer_Area_4',
-              'Layer_Area_5', 'Layer_Area_6', 'Layer_Area_7', 'Layer_Area_8', 'Layer_Area_9',
-              'Layer_Area_10', 'Layer_Area_11', 'Layer_Area_12', 'Layer_Area_13', 'Layer_Area_14',
-              'Layer_Area_15', 'Layer_Area_16', 'Layer_Area_17', 'Layer_Area_18', 'Layer_Area_19',
-              'Layer_Area_20', 'Layer_Area_21', 'Layer_Area_22', 'Layer_Area_23', 'Layer_Area_24',
-
-              'Layer_CNO_0', 'Layer_CNO_1', 'Layer_CNO_2', 'Layer_CNO_3', 'Layer_CNO_4',
-              'Layer_CNO_5', 'Layer_CNO_6', 'Layer_CNO_7', 'Layer_CNO_8', 'Layer_CNO_9',
-              'Layer_CNO_10', 'Layer_CNO_11', 'Layer_CNO_12', 'Layer_CNO_13', 'Layer_CNO_14',
-              'Layer_CNO_15', 'Layer_CNO_16', 'Layer_CNO_17', 'Layer_CNO_18', 'Layer_CNO_19',
-              'Layer_CNO_20', 'Layer_CNO_21', 'Layer_CNO_22', 'Layer_CNO_23', 'Layer_CNO_24',
-
-              'Layer_Density_0', 'Layer_Density_1', 'Layer_Density_2', 'Layer_Density_3',
-              'Layer_Density_4', 'Layer_Density_5', 'Layer_Density_6', 'Layer_Density_7',
-              'Layer_Density_8', 'Layer_Density_9', 'Layer_Density_10', 'Layer_Density_11',
-              'Layer_Density_12', 'Layer_Density_13', 'Layer_Density_14', 'Layer_Density_15',
-              'Layer_Density_16', 'Layer_Density_17', 'Layer_Density_18', 'Layer_Density_19',
-              'Layer_Density_20', 'Layer_Density_21', 'Layer_Density_22', 'Layer_Density_23',
-              'Layer_Density_24',
-
-              'AVG_Area', 'AVG_Size']
-
-    writer = csv.writer(f)
-    writer.writerow(header)
-
-    for i in range(len(file_list)):
-        data = [file_list[i], Country, AD_group, Number, TLSS, lesional, CNO_list[0][i],
-
-                Layer_area[i][0], Layer_area[i][1], Layer_area[i][2], Layer_area[i][3], Layer_area[i][4],
-                Layer_area[i][5], Layer_area[i][6], Layer_area[i][7], Layer_area[i][8], Layer_area[i][9],
-                Layer_area[i][10], Layer_area[i][11], Layer_area[i][12], Layer_area[i][13],
-                Layer_area[i][14], Layer_area[i][15], Layer_area[i][16], Layer_area[i][17],
-                Layer_area[i][18], Layer_area[i][19], Layer_area[i][20], Layer_area[i][21],
-                Layer_area[i][22], Layer_area[i][23], Layer_area[i][24],
-
-                Layer_cno[i][0], Layer_cno[i][1], Layer_cno[i][2], Layer_cno[i][3], Layer_cno[i][4],
-                Layer_cno[i][5], Layer_cno[i][6], Layer_cno[i][7], Layer_cno[i][8], Layer_cno[i][9],
-                Layer_cno[i][10], Layer_cno[i][11], Layer_cno[i][12], Layer_cno[i][13], Layer_cno[i][14],
-                Layer_cno[i][15], Layer_cno[i][16], Layer_cno[i][17], Layer_cno[i][18], Layer_cno[i][19],
-                Layer_cno[i][20], Layer_cno[i][21], Layer_cno[i][22], Layer_cno[i][23], Layer_cno[i][24],
-
-                Layer_density[i][0], Layer_density[i][1], Layer_density[i][2], Layer_density[i][3],
-                Layer_density[i][4], Layer_density[i][5], Layer_density[i][6], Layer_density[i][7],
-                Layer_density[i][8], Layer_density[i][9], Layer_density[i][10], Layer_density[i][11],
-                Layer_density[i][12], Layer_density[i][13], Layer_density[i][14], Layer_density[i][15],
-                Layer_density[i][16], Layer_density[i][17], Layer_density[i][18], Layer_density[i][19],
-                Layer_density[i][20], Layer_density[i][21], Layer_density[i][22], Layer_density[i][23],
-                Layer_density[i][24],
+    # Write CSV and the study-level Parquet dataset
+    results = folder_results(file_list, (Country, AD_group, Number, TLSS, lesional),
+                             CNO_list[0], Area_sum[0], Area_avg[0], Layer_area, Layer_cno, Layer_density)
+    write_csv(save_dir + os.sep + '{}_{}_{}_{}_.csv'.format(folder, timestr, model, conf), results)
+    write_parquet(os.path.join(os.path.dirname(folder_dir), DEFAULT_DATASET_DIR), results, folder, model, conf)
 
-                Area_sum[0][i], Area_avg[0][i]]
-        writer.writerow(data)
-    f.close()
+    # Without artifacts only the CSV is kept
+    if artifacts == 'none':
+        discard_images(enhanced_png_path, file_list)
 
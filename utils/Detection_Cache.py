@@ -0,0 +1,147 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import cv2
+import json
+import hashlib
+import numpy as np
+from collections import namedtuple
+from utils.CNO_Detector import detect_stream
+from utils.Preprocessing_Cache import file_hash
+
+# Raw detections of one image as host arrays: xywh and xyxy are (N, 4) float32, conf is (N,) float32.
+# box_geometry accepts it in place of an ultralytics Boxes object.
+Detections = namedtuple('Detections', ['xywh', 'xyxy', 'conf'])
+
+DEFAULT_CACHE_MB = 512
+
+# Checkpoint hashes computed in this process, keyed by (path, size, mtime)
+_checkpoint_hashes = {}
+
+
+# Copy the boxes of one YOLO result to host memory
+def detections_from_boxes(boxes):
+    return Detections(boxes.xywh.cpu().numpy().astype(np.float32),
+                      boxes.xyxy.cpu().numpy().astype(np.float32),
+                      boxes.conf.cpu().numpy().astype(np.float32))
+
+
+# Content hash of a model checkpoint, computed once per process while the file is unchanged
+def checkpoint_hash(model_path):
+    model_path = os.path.abspath(str(model_path))
+    stat = os.stat(model_path)
+    key = (model_path, stat.st_size, stat.st_mtime)
+    if key not in _checkpoint_hashes:
+        _checkpoint_hashes[key] = file_hash(model_path)
+    return _checkpoint_hashes[key]
+
+
+# Persistent store of raw detections, one compressed .npz file of column arrays per (image, model, settings) key.
+# The least recently used entries are evicted once the directory grows past max_mb; max_mb=0 or no directory
+# disables the cache.
+class DetectionCache:
+    def __init__(self, cache_dir, max_mb=DEFAULT_CACHE_MB):
+        self.cache_dir = None if cache_dir is None else str(cache_dir)
+        self.max_bytes = int(max_mb * 1024 * 1024) if cache_dir is not None else 0
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    # Cache key of one image under a model checkpoint and prediction settings
+    @staticmethod
+    def key(image_hash, model_hash, settings):
+        payload = json.dumps({'image': image_hash, 'model': model_hash, 'settings': settings}, sort_keys=True)
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    # Return the cached Detections for a key, or None on a miss
+    def get(self, key):
+        if not self.enabled:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                detections = Detections(data['xywh'], data['xyxy'], data['conf'])
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)  # Mark as recently used for eviction
+        self.hits += 1
+        return detections
+
+    def put(self, key, detections):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, xywh=detections.xywh, xyxy=detections.xyxy, conf=detections.conf)
+        os.replace(tmp_path, path)
+
+    # Delete the least recently used entries until the cache fits in its size budget
+    def evict(self):
+        if not self.enabled:
+            return 0
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.npz') and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        return evicted
+
+
+# Run detection through the cache and yield (path, image, Detections) in the order of image_paths.
+# Cached images are only decoded for drawing; the misses of each batch go to the detector together and are stored.
+# Without a cache (or with a disabled one) this is detect_stream with the boxes copied to host arrays.
+# With evict=False the cache is not trimmed at the end, for callers running many small batches.
+def detect_cached(detector, model_path, image_paths, cache=None, batch_size=8, evict=True, **predict_args):
+    if cache is None:
+        cache = DetectionCache(None)
+    model_hash = checkpoint_hash(model_path) if cache.enabled else None
+    settings = {name: value for name, value in predict_args.items() if name not in ('save', 'save_txt', 'verbose')}
+    image_paths = list(image_paths)
+
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        if cache.enabled:
+            keys = [cache.key(file_hash(path), model_hash, settings) for path in batch_paths]
+        else:
+            keys = [None] * len(batch_paths)
+        cached = [cache.get(key) for key in keys]
+
+        misses = [path for path, detections in zip(batch_paths, cached) if detections is None]
+        fresh = {}
+        for path, result in detect_stream(detector, misses, batch_size=batch_size, **predict_args):
+            fresh[path] = (result.orig_img, detections_from_boxes(result.boxes))
+
+        for path, key, detections in zip(batch_paths, keys, cached):
+            if detections is None:
+                image, detections = fresh[path]
+                cache.put(key, detections)
+            else:
+                image = cv2.imread(str(path))
+            yield path, image, detections
+
+    if cache.enabled and evict:
+        cache.evict()
+        print("Detection cache: {} hits, {} misses".format(cache.hits, cache.misses))
@@ -3,34 +3,79 @@
 import os
 import re
 import numpy as np
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 import warnings
 import matplotlib.pyplot as plt
 from scipy import ndimage
 from matplotlib import cm
 from PIL import Image
 from skimage import io, morphology
+from skimage.filters import rank
 from NSFopen import read
 
 
 warnings.filterwarnings('ignore')  # Suppress warnings
 
+BCR_HEADER_SIZE = 2048  # Fixed-size ASCII header preceding the .bcr payload
+BCR_DTYPE = np.dtype('<i2')  # Payload words are little-endian signed 16-bit integers
+
+GAUSSIAN_SIGMA = 10  # Smoothing of the row profile used to reduce horizontal artifacts
+
+# Pyramid contrast parameters
+DISK_RADII = (9, 15)  # Disk footprint radii of the local percentile filters
+PERCENTILES = (10, 90)  # Local lower/upper percentiles used as black and white points
+PERCENTILE_BIT_DEPTH = 8  # Intensity quantization of the rank filters, see disk_percentiles (None is exact)
+
+
+# Parameters that determine the preprocessed images; cached images are only reused when these are unchanged
+def preprocessing_params():
+    return {'gaussian_sigma': GAUSSIAN_SIGMA,
+            'disk_radii': list(DISK_RADII),
+            'percentiles': list(PERCENTILES),
+            'percentile_bit_depth': PERCENTILE_BIT_DEPTH}
+
+
+# Parse and validate the xpixels/ypixels fields of a .bcr header
+def read_bcr_header(header):
+    header = header.decode('latin-1')
+    dims = []
+    for key in ('xpixels', 'ypixels'):
+        match = re.search(key + r'\s?=\s?([0-9]+)', header)
+        if match is None:
+            raise ValueError("Invalid .bcr header: missing '{}' field".format(key))
+        value = int(match.group(1))
+        if value <= 0:
+            raise ValueError("Invalid .bcr header: '{}' must be positive, got {}".format(key, value))
+        dims.append(value)
+    return dims[0], dims[1]
+
+
+# Memory-map the raw .bcr payload as a (ypixels, xpixels) int16 array without copying it
+def read_bcr(fn):
+    with open(fn, 'rb') as f:
+        header = f.read(BCR_HEADER_SIZE)
+    if len(header) < BCR_HEADER_SIZE:
+        raise ValueError("Invalid .bcr file {}: shorter than the {}-byte header".format(fn, BCR_HEADER_SIZE))
+    xpix, ypix = read_bcr_header(header)
+
+    payload_size = os.path.getsize(fn) - BCR_HEADER_SIZE
+    expected_size = xpix * ypix * BCR_DTYPE.itemsize
+    if payload_size < expected_size:
+        raise ValueError("Invalid .bcr file {}: header declares {}x{} pixels ({} bytes) but payload has {} bytes"
+                         .format(fn, xpix, ypix, expected_size, payload_size))
+
+    return np.memmap(fn, dtype=BCR_DTYPE, mode='r', offset=BCR_HEADER_SIZE, shape=(ypix, xpix))
+
 
 # Load an image from a file and preprocess it to remove horizontal artifacts and normalize its intensity
 def load_im(fn):
-    f = open(fn, 'rb')
-    a = f.read()
-    f.close()
-    aa = str(a[:2048])
-    xpix = int(re.findall('xpixels\s?=\s?([0-9]*)', aa)[0])
-    ypix = int(re.findall('ypixels\s?=\s?([0-9]*)', aa)[0])
-    a = a[2048:]
-
-    words = [a[k * 2:k * 2 + 2] for k in range(xpix * ypix)]
-    arr = [int.from_bytes(words[k], byteorder='little', signed=True) for k in range(len(words))]
-    im = np.array(arr).reshape((ypix, xpix))
+    # Widen to int64 in one pass (the filter below keeps the input dtype, so this preserves the original results)
+    im = np.array(read_bcr(fn), dtype=np.int64)
 
     im = (im.T - np.mean(im, axis=1) +
-          np.mean(ndimage.gaussian_filter(im, 10), axis=1)).T  # Reduce horizontal artifacts
+          np.mean(ndimage.gaussian_filter(im, GAUSSIAN_SIGMA), axis=1)).T  # Reduce horizontal artifacts
 
     im = im - np.min(im)
     im = im / np.max(im)  # normalize to 0.0-1.0
@@ -49,14 +94,35 @@ def normalize_to_uint8(array):
     return norm_array.astype(np.uint8)
 
 
-# Apply pyramid contrast enhancement to an image
-def pyramid_contrast(im):
+# Compute local percentiles of an image over a disk footprint.
+# The image is quantized to bit_depth bits and filtered with skimage's sliding-histogram rank filter,
+# which returns exactly ndimage.percentile_filter of the quantized image (reflected borders included),
+# so the maps are within half a quantization step, 0.5 / (2 ** bit_depth - 1), of the exact filter.
+# pyramid_contrast divides by the local range M - m, which amplifies this error where the range is small: on synthetic
+# scans the enhanced PNGs differ from the exact ones by up to 7-11/255 at 8 bits (about 1 in 5 pixels by more than
+# 1/255) and up to 4/255 at 10 bits. Higher bit depths are more precise but slower; bit_depth=None runs
+# ndimage.percentile_filter directly and reproduces the original enhancement exactly.
+def disk_percentiles(im, radius, percentiles=PERCENTILES, bit_depth=PERCENTILE_BIT_DEPTH):
+    disk = morphology.disk(radius)
+    if bit_depth is None:
+        return [ndimage.percentile_filter(im, p, footprint=disk) for p in percentiles]
+
+    if not 1 <= bit_depth <= 12:
+        raise ValueError("bit_depth must be between 1 and 12, got {}".format(bit_depth))
+    levels = 2 ** bit_depth - 1
+    quantized = np.rint(np.clip(im, 0, 1) * levels).astype(np.uint8 if bit_depth <= 8 else np.uint16)
+    # Symmetric padding reproduces ndimage's 'reflect' border mode and keeps the full footprint at the edges
+    padded = np.pad(quantized, radius, mode='symmetric')
+    crop = (slice(radius, -radius), slice(radius, -radius))
+    return [rank.percentile(padded, disk, p0=p / 100.0)[crop] / levels for p in percentiles]
+
+
+# Apply pyramid contrast enhancement to an image (expects intensities normalized to 0.0-1.0)
+def pyramid_contrast(im, bit_depth=PERCENTILE_BIT_DEPTH):
     oom = []
     # Different disk sizes for contrast enhancement
-    for d in (9, 15): # (9, 11, 13, 15, 17,25): #(3, 6, 9, 12, 15, 18, 21):
-        disk = morphology.disk(d)
-        m = ndimage.percentile_filter(im, 10, footprint=disk)
-        M = ndimage.percentile_filter(im, 90, footprint=disk)
+    for d in DISK_RADII: # (9, 11, 13, 15, 17,25): #(3, 6, 9, 12, 15, 18, 21):
+        m, M = disk_percentiles(im, d, PERCENTILES, bit_depth)
         om = (im - m) / (M - m)
         om = np.nan_to_num(om).clip(0, 1)
         # plt.imshow(om)
@@ -79,6 +145,16 @@ def present(im, land):
     return original_im, enhanced_im
 
 
+# Orient one .nid Z-Axis channel like a .bcr scan, reduce its horizontal artifacts and normalize it (as in load_im)
+def nid_image(z_axis):
+    im = np.array(z_axis, dtype=float)
+    im = np.flipud(im)  # Flip vertically to match .bcr orientation
+    im = (im.T - np.mean(im, axis=1) +
+          np.mean(ndimage.gaussian_filter(im, GAUSSIAN_SIGMA), axis=1)).T  # Reduce horizontal artifacts
+    im = im - np.min(im)
+    return im / np.max(im) if np.max(im) != 0 else im  # normalize to 0.0-1.0
+
+
 # Process a single .nid file, extract Forward/Backward data, and apply contrast enhancement
 def process_nid_file(fn, original_png_path, enhanced_png_path, direction="both"):
     try:
@@ -93,33 +169,21 @@ def process_nid_file(fn, original_png_path, enhanced_png_path, direction="both")
 
         # Process backward data if direction is "backward" or "both"
         if direction in ["backward", "both"]:
-            im = np.array(backward_data, dtype=float)
-            im = np.flipud(im)  # Flip vertically to match .bcr orientation
-            # Reduce horizontal artifacts (as in load_im)
-            im = (im.T - np.mean(im, axis=1) +
-                  np.mean(ndimage.gaussian_filter(im, 10), axis=1)).T
-            # Normalize to 0.0–1.0 (as in load_im)
-            im = im - np.min(im)
-            im = im / np.max(im) if np.max(im) != 0 else im
+            im = nid_image(backward_data)
             land = pyramid_contrast(im)
             original_im, enhanced_im = present(im, land)
-            original_im.save(os.path.join(original_png_path, f"{base}_backward.png"))
+            if original_png_path is not None:
+                original_im.save(os.path.join(original_png_path, f"{base}_backward.png"))
             enhanced_im.save(os.path.join(enhanced_png_path, f"{base}_backward.png"))
             processed_images.append(f"{base}_backward")
 
         # Process forward data if direction is "forward" or "both"
         if direction in ["forward", "both"]:
-            im = np.array(forward_data, dtype=float)
-            im = np.flipud(im)  # Flip vertically to match .bcr orientation
-            # Reduce horizontal artifacts (as in load_im)
-            im = (im.T - np.mean(im, axis=1) +
-                  np.mean(ndimage.gaussian_filter(im, 10), axis=1)).T
-            # Normalize to 0.0–1.0 (as in load_im)
-            im = im - np.min(im)
-            im = im / np.max(im) if np.max(im) != 0 else im
+            im = nid_image(forward_data)
             land = pyramid_contrast(im)
             original_im, enhanced_im = present(im, land)
-            original_im.save(os.path.join(original_png_path, f"{base}_forward.png"))
+            if original_png_path is not None:
+                original_im.save(os.path.join(original_png_path, f"{base}_forward.png"))
             enhanced_im.save(os.path.join(enhanced_png_path, f"{base}_forward.png"))
             processed_images.append(f"{base}_forward")
 
@@ -130,6 +194,7 @@ def process_nid_file(fn, original_png_path, enhanced_png_path, direction="both")
 
 
 # Process a single image file, enhance its contrast, and saßve the original and enhanced images
+# (the original image is skipped when original_png_path is None)
 def treat_one_image(fn, original_png_path, enhanced_png_path, file_type):
     # Load image
     if file_type == "nid":
@@ -153,8 +218,84 @@ def treat_one_image(fn, original_png_path, enhanced_png_path, file_type):
         # Visualize and save the original and enhanced images
         original_im, enhanced_im = present(im, land)
         file_name = os.path.split(fn)[1][0:-4]
-        original_im.save(os.path.join(original_png_path, file_name) + '.png')
+        if original_png_path is not None:
+            original_im.save(os.path.join(original_png_path, file_name) + '.png')
         enhanced_im.save(os.path.join(enhanced_png_path, file_name) + '.png')
 
     return file_name
 
+
+# Resolve a configured worker count, where None or 0 means one worker per CPU core
+def resolve_workers(workers):
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+# Process pool for the CPU-bound stages. Workers are spawned instead of forked: the pools are created in processes
+# that already run threads (torch/YOLO, pipeline stages, the GUI analysis thread), and a forked child inherits the
+# locks those threads held at that moment, which can deadlock it.
+# Create it once per run (spawning workers takes seconds) and pass it to the folders.
+def process_pool(workers):
+    return ProcessPoolExecutor(max_workers=resolve_workers(workers), mp_context=multiprocessing.get_context('spawn'))
+
+
+# The process pool of the run when one is given (left running on exit), otherwise a new pool for this call only
+def run_pool(executor, workers):
+    return nullcontext(executor) if executor is not None else process_pool(workers)
+
+
+# Preprocess one file inside a worker process, capturing the error so a bad scan does not stop the folder
+def _preprocess_task(task):
+    fn, original_png_path, enhanced_png_path = task
+    file_type = "bcr" if fn.lower().endswith('.bcr') else "nid"
+    try:
+        file_name = treat_one_image(fn, original_png_path, enhanced_png_path, file_type)
+    except Exception as e:
+        return fn, None, "{}: {}".format(type(e).__name__, e)
+    if file_name is None:
+        return fn, None, "no image data could be extracted"
+    return fn, file_name, None
+
+
+# Preprocess a list of files on a process pool (executor, or a new one with the given number of workers).
+# Returns {file: [image names]} in the input order for the files that succeeded, and {file: error} for the others.
+# progress(done, total) is called after every file; an exception raised by it cancels the files not yet started.
+def preprocess_files(files, original_png_path, enhanced_png_path, workers=None, progress=None, executor=None):
+    tasks = [(fn, original_png_path, enhanced_png_path) for fn in files]
+    workers = min(resolve_workers(workers), max(len(tasks), 1))
+
+    outputs = {}
+    errors = {}
+
+    def collect(results):
+        for i, (fn, file_name, error) in enumerate(results):
+            if error is not None:
+                print("Failed to preprocess {}: {}".format(fn, error))
+                errors[fn] = error
+            else:
+                outputs[fn] = file_name if isinstance(file_name, list) else [file_name]
+                print(i, end=' ')
+            if progress is not None:
+                progress(i + 1, len(tasks))
+
+    if executor is None and workers == 1:
+        collect(map(_preprocess_task, tasks))
+    else:
+        with run_pool(executor, workers) as pool:
+            futures = [pool.submit(_preprocess_task, task) for task in tasks]
+            try:
+                collect(future.result() for future in futures)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    return outputs, errors
+
+
+# Preprocess a list of files on a process pool; image names follow the input order and failures are reported per file
+def preprocess_images(files, original_png_path, enhanced_png_path, workers=None):
+    outputs, errors = preprocess_files(files, original_png_path, enhanced_png_path, workers)
+    file_list = [name for names in outputs.values() for name in names]
+    return file_list, errors
@@ -0,0 +1,148 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from utils.CNO_Detector import get_detector
+
+MAX_BATCH = 8  # Images passed to one YOLO call
+BATCH_WAIT = 0.05  # Seconds a worker waits for more images to fill a batch
+CONCURRENCY_LIMIT = 1  # YOLO calls running at the same time, over all models
+MAX_QUEUED = 64  # Images waiting per model before new requests are turned away
+
+
+# Raised by submit() when the queue of a model is full
+class ServiceBusy(Exception):
+    pass
+
+
+# Raised by submit() when one upload has more images than a model may queue, so it could never be accepted
+class TooManyImages(Exception):
+    pass
+
+
+# Images of one upload, resolved as a whole once every image has been detected
+class _Request:
+    def __init__(self, n_images):
+        self.future = Future()
+        self.results = [None] * n_images
+        self.remaining = n_images
+        self.lock = threading.Lock()
+
+    def finish(self, index, result):
+        with self.lock:
+            self.results[index] = result
+            self.remaining -= 1
+            done = self.remaining == 0
+        if done and not self.future.done():  # A failed batch may already have resolved it
+            self.future.set_result(self.results)
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+# Shared CNO detection for the web app. Every model has its own queue and worker thread (one, since a YOLO predictor
+# is not thread-safe), and a semaphore caps the YOLO calls running at once over all models. Workers take queued images
+# in arrival order and pass up to max_batch images with the same thresholds, from any number of uploads, to one call.
+class InferenceService:
+    def __init__(self, model_paths, max_batch=MAX_BATCH, batch_wait=BATCH_WAIT, concurrency=CONCURRENCY_LIMIT,
+                 max_queued=MAX_QUEUED, predict_args=None):
+        self.model_paths = dict(model_paths)
+        self.max_batch = max(1, int(max_batch))
+        self.batch_wait = max(0.0, float(batch_wait))
+        self.max_queued = max(1, int(max_queued))
+        self.predict_args = predict_args or {}
+        self.slots = threading.BoundedSemaphore(max(1, int(concurrency)))
+        self.queues = {}
+        self.queued = {}
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    # Queue images (BGR arrays) for detection with one model. Returns a Future of the YOLO results in image order.
+    # Raises TooManyImages for more than max_queued images, and ServiceBusy when the model has too many images waiting
+    # to queue them now.
+    def submit(self, model, images, conf, iou):
+        request = _Request(len(images))
+        if not images:
+            request.future.set_result([])
+            return request.future
+        if len(images) > self.max_queued:
+            raise TooManyImages("Too many images ({} uploaded, max {})".format(len(images), self.max_queued))
+        with self.lock:
+            if model not in self.model_paths:
+                raise KeyError("Unknown model {}".format(model))
+            waiting = self.queued.get(model, 0)
+            if waiting + len(images) > self.max_queued:
+                raise ServiceBusy("{} images are waiting for {}".format(waiting, model))
+            if model not in self.workers:
+                self.queues[model] = queue.Queue()
+                self.queued[model] = 0
+                self.workers[model] = threading.Thread(target=self._work, args=(model,),
+                                                       name='inference-' + model, daemon=True)
+                self.workers[model].start()
+            self.queued[model] += len(images)
+            for index, image in enumerate(images):
+                self.queues[model].put((request, index, image, (conf, iou)))
+        return request.future
+
+    # Number of images waiting for each model
+    def queue_sizes(self):
+        with self.lock:
+            return dict(self.queued)
+
+    # Next batch of one model: the oldest image, then the images queued behind it with the same thresholds, up to
+    # max_batch or until batch_wait has passed. Images with other thresholds are kept, in order, for later batches.
+    def _next_batch(self, model, deferred):
+        job = deferred.popleft() if deferred else self.queues[model].get()
+        if job is None:
+            return None
+        batch = [job]
+        settings = job[3]
+        skipped = deque()
+        while deferred and len(batch) < self.max_batch:
+            job = deferred.popleft()
+            (batch if job[3] == settings else skipped).append(job)
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                job = self.queues[model].get(timeout=timeout) if timeout > 0 else self.queues[model].get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                self.queues[model].put(None)  # Stop once the queued images are done
+                break
+            (batch if job[3] == settings else skipped).append(job)
+        deferred.extendleft(reversed(skipped))
+        return batch
+
+    def _work(self, model):
+        deferred = deque()
+        while True:
+            batch = self._next_batch(model, deferred)
+            if batch is None:
+                return
+            with self.lock:
+                self.queued[model] -= len(batch)
+
+            conf, iou = batch[0][3]
+            try:
+                detector = get_detector(self.model_paths[model])
+                with self.slots:
+                    results = detector.predict([job[2] for job in batch], conf=conf, iou=iou, verbose=False,
+                                               **self.predict_args)
+            except Exception as e:
+                for request, _, _, _ in batch:
+                    request.fail(e)
+                continue
+            for (request, index, _, _), result in zip(batch, results):
+                request.finish(index, result)
+
+    # Stop the workers after the images already queued
+    def close(self):
+        with self.lock:
+            for model_queue in self.queues.values():
+                model_queue.put(None)
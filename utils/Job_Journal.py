@@ -0,0 +1,85 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import json
+import time
+import zlib
+import socket
+import hashlib
+
+# Journal of the analysed folders, next to them like the results dataset. The leading dot keeps it out of the
+# folder listing.
+DEFAULT_JOURNAL_DIR = '.journal'
+
+
+# Parse a shard given as "i/n", with 0 <= i < n
+def parse_shard(text):
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError("shard must be given as i/n, e.g. 0/4: {!r}".format(text))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("shard index must be between 0 and n - 1: {!r}".format(text))
+    return index, count
+
+
+# Whether a folder belongs to shard (i, n). Folders are assigned by a hash of their name, so machines sharing a
+# filesystem agree on the split without talking to each other, and adding folders does not move the others.
+def in_shard(folder, shard):
+    index, count = shard
+    return zlib.crc32(folder.encode('utf-8')) % count == index
+
+
+# Fingerprint of the scans of one folder (paths relative to the study root, sizes and modification times).
+# A folder whose scans changed since it was journaled is analysed again.
+def scans_signature(scans, root):
+    digest = hashlib.sha1()
+    for scan in scans:
+        digest.update('{}\0{}\0{!r}\n'.format(os.path.relpath(scan.path, root), scan.size, scan.mtime).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Append-only JSON lines journal of the folders of one analysis (study, model and threshold).
+# Every shard appends to its own file, so shards never write to the same file, and every record is flushed to disk
+# before the next folder starts. On start the records of all shards are read, so a run resumes with any number of
+# shards. The latest record of a folder wins; folders whose last record is 'done' for the same scans are skipped.
+class JobJournal:
+    def __init__(self, directory, shard=(0, 1)):
+        self.directory = directory
+        self.path = os.path.join(directory, 'shard-{}-of-{}.jsonl'.format(*shard))
+        self.records = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.jsonl'):
+                continue
+            with open(os.path.join(self.directory, name)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Last line of a run killed while writing it
+                    latest = self.records.get(record['folder'])
+                    if latest is None or record['time'] >= latest['time']:
+                        self.records[record['folder']] = record
+
+    # Whether a folder was completed with the same scans
+    def done(self, folder, signature):
+        record = self.records.get(folder)
+        return record is not None and record['status'] == 'done' and record['scans'] == signature
+
+    # Append the outcome of one folder ('done' or 'failed') with any extra fields (files, errors, seconds, ...)
+    def record(self, folder, status, signature, **fields):
+        record = {'folder': folder, 'status': status, 'scans': signature, 'time': time.time(),
+                  'host': socket.gethostname(), 'pid': os.getpid()}
+        record.update(fields)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[folder] = record
+        return record
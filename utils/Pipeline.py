@@ -0,0 +1,144 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import time
+import queue
+import threading
+
+QUEUE_SIZE = 16  # Items buffered between two stages before the upstream stage blocks
+
+_END = object()  # End-of-stream marker, one per downstream worker
+
+
+# One step of a StagedPipeline.
+# function maps one payload to one payload, or a list of payloads to a list when batch_size > 1. Batches are filled
+# opportunistically: a worker takes what is already queued (up to batch_size) instead of waiting for a full batch.
+# With expand=True the function returns a list and every element continues as a separate item.
+class Stage:
+    def __init__(self, name, function, workers=1, batch_size=1, expand=False):
+        self.name = name
+        self.function = function
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.expand = expand
+        self.items = 0
+        self.busy = 0.0  # Seconds spent inside function, summed over workers
+        self.blocked = 0.0  # Seconds spent waiting for room in the downstream queue (backpressure)
+        self.lock = threading.Lock()
+
+    def utilization(self, wall_time):
+        return self.busy / (wall_time * self.workers) if wall_time > 0 else 0.0
+
+
+# Run items through a chain of stages connected by bounded queues, each stage on its own worker threads.
+# Stages overlap: while one image is being detected the next ones are preprocessed and earlier ones analysed,
+# and the bounded queues stop a fast stage from running ahead of a slow one, which caps memory.
+# CPU-bound stages hand their work to a process pool; create it with Img_Preprocessing.process_pool, which spawns
+# its workers, since forking from the stage threads can deadlock the child.
+# run() returns the final payloads in input order and the errors as {item key: (stage name, message)}.
+class StagedPipeline:
+    def __init__(self, stages, queue_size=QUEUE_SIZE):
+        self.stages = list(stages)
+        self.queue_size = max(1, int(queue_size))
+        self.wall_time = 0.0
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        results = {}
+        errors = {}
+        results_lock = threading.Lock()
+
+        def put(stage, out_queue, entry):
+            start = time.perf_counter()
+            out_queue.put(entry)
+            with stage.lock:
+                stage.blocked += time.perf_counter() - start
+
+        def emit(stage, out_queue, key, payload):
+            entries = [(key + (i,), item) for i, item in enumerate(payload)] if stage.expand else [(key, payload)]
+            for entry in entries:
+                if out_queue is None:
+                    with results_lock:
+                        results[entry[0]] = entry[1]
+                else:
+                    put(stage, out_queue, entry)
+
+        def worker(index):
+            stage = self.stages[index]
+            in_queue = queues[index]
+            out_queue = queues[index + 1] if index + 1 < len(queues) else None
+            finished = False
+            while not finished:
+                entry = in_queue.get()
+                if entry is _END:
+                    break
+                batch = [entry]
+                while len(batch) < stage.batch_size:
+                    try:
+                        entry = in_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is _END:
+                        finished = True
+                        break
+                    batch.append(entry)
+
+                keys = [key for key, _ in batch]
+                start = time.perf_counter()
+                try:
+                    if stage.batch_size > 1:
+                        outputs = stage.function([payload for _, payload in batch])
+                    else:
+                        outputs = [stage.function(batch[0][1])]
+                except Exception as e:
+                    message = "{}: {}".format(type(e).__name__, e)
+                    print("Stage {} failed for {} item(s): {}".format(stage.name, len(batch), message))
+                    with results_lock:
+                        for key in keys:
+                            errors[key] = (stage.name, message)
+                    outputs = None
+                with stage.lock:
+                    stage.busy += time.perf_counter() - start
+                    stage.items += len(batch)
+
+                if outputs is not None:
+                    for key, payload in zip(keys, outputs):
+                        emit(stage, out_queue, key, payload)
+
+        # Close each stage once all of its workers are done, then close the next one
+        def close(index, threads):
+            for thread in threads:
+                thread.join()
+            if index + 1 < len(self.stages):
+                for _ in range(self.stages[index + 1].workers):
+                    queues[index + 1].put(_END)
+
+        start = time.perf_counter()
+        closers = []
+        for index, stage in enumerate(self.stages):
+            threads = [threading.Thread(target=worker, args=(index,), name='{}-{}'.format(stage.name, i), daemon=True)
+                       for i in range(stage.workers)]
+            for thread in threads:
+                thread.start()
+            closer = threading.Thread(target=close, args=(index, threads), daemon=True)
+            closer.start()
+            closers.append(closer)
+
+        for key, item in enumerate(items):
+            queues[0].put(((key,), item))
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_END)
+
+        for closer in closers:
+            closer.join()
+        self.wall_time = time.perf_counter() - start
+
+        return [results[key] for key in sorted(results)], errors
+
+    # Print items, busy time, backpressure and utilization (busy time / (wall time x workers)) of every stage
+    def report(self):
+        print("\nPipeline: {:.2f} secs".format(self.wall_time))
+        print("{:<12}{:>8}{:>8}{:>10}{:>10}{:>8}".format('Stage', 'Workers', 'Items', 'Busy (s)', 'Blocked', 'Util'))
+        for stage in self.stages:
+            print("{:<12}{:>8}{:>8}{:>10.2f}{:>10.2f}{:>7.0f}%".format(
+                stage.name, stage.workers, stage.items, stage.busy, stage.blocked,
+                100 * stage.utilization(self.wall_time)))
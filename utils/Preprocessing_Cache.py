@@ -0,0 +1,169 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import json
+import hashlib
+import threading
+from utils.Img_Preprocessing import preprocess_files, preprocessing_params, _preprocess_task
+
+MANIFEST_NAME = 'preprocessing_manifest.json'  # Written next to the Original/Enhanced directories
+MANIFEST_VERSION = 2  # Version 1 keyed the scans by the path the scanner saw
+HASH_CHUNK_SIZE = 1 << 20
+
+
+# Content hash of a source scan, read in chunks so large files are never fully loaded
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Location of the manifest describing the cached images of one folder
+def manifest_path(enhanced_png_path):
+    return os.path.join(os.path.dirname(os.path.normpath(enhanced_png_path)), MANIFEST_NAME)
+
+
+# Manifest key of a scan: its path relative to the analysed folder (the one holding CNO_Detection/Image/Enhanced),
+# so the folder reached through a relative, absolute or moved path keeps its entries
+def scan_key(path, enhanced_png_path):
+    folder = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(enhanced_png_path))))
+    return os.path.relpath(os.path.realpath(path), folder).replace(os.sep, '/')
+
+
+# Load a manifest, starting from an empty one when it is missing, unreadable or from another version
+def load_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('files', {})
+
+
+# Write the manifest atomically so an interrupted run never leaves a truncated file behind
+def save_manifest(path, files):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+# Preprocessed images of one folder, tracked per scan in the folder manifest (original_png_path=None skips the
+# Original images).
+# Every scan is keyed on its content hash and the preprocessing parameters; the hash is only recomputed when the
+# file size or mtime changed. Images are only deleted by finish(), once the images of every current scan are known.
+# lookup() and record() may be called from several threads.
+class PreprocessingCache:
+    def __init__(self, original_png_path, enhanced_png_path):
+        self.original_png_path = original_png_path
+        self.enhanced_png_path = enhanced_png_path
+        self.image_dirs = tuple(path for path in (original_png_path, enhanced_png_path) if path is not None)
+        self.path = manifest_path(enhanced_png_path)
+        self.params = preprocessing_params()
+        self.cached_files = load_manifest(self.path)
+        self.files = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def key(self, scan):
+        return scan_key(scan.path, self.enhanced_png_path)
+
+    # Return the cached image names of a scan, or None when it has to be preprocessed
+    def lookup(self, scan):
+        key = self.key(scan)
+        cached = self.cached_files.get(key)
+        if cached is not None and cached.get('size') == scan.size and cached.get('mtime') == scan.mtime:
+            digest = cached.get('hash')
+        else:
+            digest = file_hash(scan.path)
+
+        entry = {'size': scan.size, 'mtime': scan.mtime, 'hash': digest, 'params': self.params}
+        if (cached is not None and cached.get('hash') == digest and cached.get('params') == self.params and
+                all(os.path.isfile(os.path.join(image_dir, name + '.png'))
+                    for name in cached.get('outputs', []) for image_dir in self.image_dirs)):
+            entry['outputs'] = cached['outputs']
+            with self.lock:
+                self.files[key] = entry
+            return entry['outputs']
+
+        with self.lock:
+            self.pending[key] = entry
+        return None
+
+    # Record the image names produced for a scan that lookup() reported as missing
+    def record(self, scan, outputs):
+        key = self.key(scan)
+        with self.lock:
+            entry = self.pending.pop(key)
+            entry['outputs'] = list(outputs)
+            self.files[key] = entry
+
+    # Preprocess one scan on a process pool unless its images are cached; returns its image names
+    def prepare(self, scan, executor):
+        outputs = self.lookup(scan)
+        if outputs is None:
+            fn, file_name, error = executor.submit(
+                _preprocess_task, (scan.path, self.original_png_path, self.enhanced_png_path)).result()
+            if error is not None:
+                raise RuntimeError("Failed to preprocess {}: {}".format(fn, error))
+            outputs = file_name if isinstance(file_name, list) else [file_name]
+            self.record(scan, outputs)
+        return outputs
+
+    # Evict every image no current scan produced (images of deleted, changed or failed scans and images left by
+    # older runs, which would otherwise be picked up when listing the image directories), then save the manifest.
+    # Images named like a current output are kept, even when an old entry listed them too.
+    # Returns the image names of the given scans in scan order.
+    def finish(self, scans):
+        keys = [self.key(scan) for scan in scans]
+        file_list = [name for key in keys if key in self.files for name in self.files[key]['outputs']]
+
+        expected = set(file_list)
+        for image_dir in self.image_dirs:
+            for name in os.listdir(image_dir):
+                if name.endswith('.png') and name[:-4] not in expected:
+                    os.remove(os.path.join(image_dir, name))
+
+        save_manifest(self.path, self.files)
+        return file_list
+
+
+# Drop the manifest entries of scans whose images were removed from the Enhanced directory (e.g. by the 'none'
+# artifact policy), so the next run preprocesses them again instead of finding an entry without images
+def forget_images(enhanced_png_path, names):
+    path = manifest_path(enhanced_png_path)
+    files = load_manifest(path)
+    names = set(names)
+    kept = {key: entry for key, entry in files.items() if names.isdisjoint(entry.get('outputs', []))}
+    if len(kept) != len(files):
+        save_manifest(path, kept)
+
+
+# Bring the preprocessed images of one folder up to date with its scans (ScanEntry list from scan_source_tree).
+# Only new or changed scans are preprocessed, images of deleted or changed scans and untracked images are
+# evicted, so the Enhanced directory holds exactly the returned images.
+# Returns (file_list, errors) like preprocess_images, with the image names in scan order.
+# progress(done, total) counts the cached scans as done; an exception raised by it stops the preprocessing.
+# executor is the process pool of the run; without one a pool of the given number of workers is started.
+def update_preprocessing(scans, original_png_path, enhanced_png_path, workers=None, progress=None, executor=None):
+    cache = PreprocessingCache(original_png_path, enhanced_png_path)
+    dirty = [scan for scan in scans if cache.lookup(scan) is None]
+
+    print("Preprocessing {} new or changed of {} scans".format(len(dirty), len(scans)))
+    cached = len(scans) - len(dirty)
+    if progress is not None:
+        progress(cached, len(scans))
+        file_progress = lambda done, total: progress(cached + done, len(scans))
+    else:
+        file_progress = None
+    outputs, errors = preprocess_files([scan.path for scan in dirty], original_png_path, enhanced_png_path, workers,
+                                       progress=file_progress, executor=executor)
+    for scan in dirty:
+        if scan.path in outputs:
+            cache.record(scan, outputs[scan.path])
+
+    return cache.finish(scans), errors
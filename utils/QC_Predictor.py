@@ -1,6 +1,9 @@
+import os
+import threading
 import torch
 from PIL import Image
 import torchvision.transforms as transforms
+from torch.utils.data import DataLoader, Dataset
 import utils.models_vit as models
 from pathlib import Path
 
@@ -12,7 +15,8 @@ class ModelPredictor:
         self.model_name = model_name
         self.num_classes = num_classes
         self.input_size = input_size
-        self.device = torch.device(device if torch.cuda.is_available() else 'cpu')
+        self.device = _resolve_device(device)
+        self.transform = self._build_transform()
         self.model = self._load_model()
 
     def _load_model(self):
@@ -40,19 +44,38 @@ class ModelPredictor:
         model.eval()
         return model
 
-    def _preprocess_image(self, image_path):
-        """Preprocess the image for model input."""
-        transform = transforms.Compose([
+    def _build_transform(self):
+        """Build the resize/normalize transform applied to every input image."""
+        return transforms.Compose([
             transforms.Resize((self.input_size, self.input_size)),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                  std=[0.229, 0.224, 0.225])
         ])
 
+    def _preprocess_image(self, image_path):
+        """Preprocess the image for model input."""
         image = Image.open(image_path).convert('RGB')
-        image_tensor = transform(image).unsqueeze(0)
+        image_tensor = self.transform(image).unsqueeze(0)
         return image_tensor
 
+    @staticmethod
+    def _format_result(image_path, probabilities):
+        """Convert the class probabilities of one image into a result dict."""
+        predicted_class = torch.argmax(probabilities).item()
+        confidence = probabilities[predicted_class].item()
+
+        result = "Passed" if predicted_class == 1 else "Failed"
+        filename = Path(image_path).name
+
+        return {
+            'filename': filename,
+            'result': result,
+            'confidence': confidence,
+            'probabilities': probabilities.cpu().numpy(),
+            'predicted_class': predicted_class
+        }
+
     def predict(self, image_path):
         """Perform prediction on a single image and return results."""
         image_tensor = self._preprocess_image(image_path)
@@ -62,21 +85,88 @@ class ModelPredictor:
             output = self.model(image_tensor)
             probabilities = torch.nn.functional.softmax(output, dim=1)
 
-        predicted_class = torch.argmax(probabilities, dim=1).item()
-        confidence = probabilities[0][predicted_class].item()
+        return self._format_result(image_path, probabilities[0])
 
-        result = "Passed" if predicted_class == 1 else "Failed"
-        filename = Path(image_path).name
+    def predict_batch(self, image_paths, batch_size=16, num_workers=2, progress=None):
+        """Perform prediction on a list of images in batches and return results in input order.
 
-        return {
-            'filename': filename,
-            'result': result,
-            'confidence': confidence,
-            'probabilities': probabilities[0].cpu().numpy(),
-            'predicted_class': predicted_class
-        }
+        Images are decoded and transformed by DataLoader workers, so the next batch is prefetched
+        while the model runs on the current one. The workers are spawned rather than forked, since the
+        caller may be running other threads (GUI analysis thread, pipeline stages) whose locks a forked
+        worker would inherit. progress(done, total) is called after every batch.
+        """
+        image_paths = list(image_paths)
+        loader = DataLoader(_ImageDataset(image_paths, self.transform), batch_size=batch_size, shuffle=False,
+                            num_workers=num_workers, pin_memory=self.device.type == 'cuda',
+                            multiprocessing_context='spawn' if num_workers > 0 else None)
+
+        results = []
+        with torch.no_grad():
+            for image_tensor in loader:
+                output = self.model(image_tensor.to(self.device, non_blocking=True))
+                probabilities = torch.nn.functional.softmax(output, dim=1).cpu()
+                for probs in probabilities:
+                    results.append(self._format_result(image_paths[len(results)], probs))
+                if progress is not None:
+                    progress(len(results), len(image_paths))
+        return results
+
+
+class _ImageDataset(Dataset):
+    """Dataset that decodes and transforms images for batched prediction."""
+
+    def __init__(self, image_paths, transform):
+        self.image_paths = image_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        image = Image.open(self.image_paths[index]).convert('RGB')
+        return self.transform(image)
+
+
+# Process-wide registry of loaded predictors, keyed by checkpoint, model configuration and device
+_predictors = {}
+_predictors_lock = threading.Lock()
+
+
+def _resolve_device(device):
+    """Fall back to the CPU when CUDA is requested but not available."""
+    return torch.device(device if torch.cuda.is_available() else 'cpu')
+
+
+def _predictor_key(checkpoint_path, model_name, num_classes, input_size, device):
+    return (os.path.abspath(str(checkpoint_path)), model_name, num_classes, input_size, str(_resolve_device(device)))
 
 
 def get_predictor(checkpoint_path, model_name='RETFound_mae', num_classes=2, input_size=224, device='cuda'):
-    """Factory function to create a predictor instance."""
-    return ModelPredictor(checkpoint_path, model_name, num_classes, input_size, device)
\ No newline at end of file
+    """Return the shared predictor for a checkpoint, loading it on first use.
+
+    The model is built and its checkpoint loaded once per process; later calls with the same
+    checkpoint path, model name and device reuse it until release_predictor is called.
+    """
+    key = _predictor_key(checkpoint_path, model_name, num_classes, input_size, device)
+    with _predictors_lock:
+        predictor = _predictors.get(key)
+        if predictor is None:
+            predictor = ModelPredictor(checkpoint_path, model_name, num_classes, input_size, device)
+            _predictors[key] = predictor
+    return predictor
+
+
+def release_predictor(checkpoint_path=None):
+    """Drop cached predictors for a checkpoint (or all of them) so their memory can be reclaimed."""
+    with _predictors_lock:
+        if checkpoint_path is None:
+            released = list(_predictors)
+        else:
+            path = os.path.abspath(str(checkpoint_path))
+            released = [key for key in _predictors if key[0] == path]
+        for key in released:
+            del _predictors[key]
+
+    if released and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return len(released)
@@ -0,0 +1,58 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import cv2
+import numpy as np
+from matplotlib import cm
+
+# Figures are drawn straight into arrays on the image pixel grid, without pyplot's global figure state,
+# so they can be rendered from any thread or worker process.
+
+SCATTER_COLOR = (180, 119, 31)  # Matplotlib's default 'C0' blue (#1f77b4) in BGR
+SCATTER_RADIUS = 2  # Pixels, close to plt.scatter(s=10) on the former 8 x 8 inch figure
+BACKGROUND = (255, 255, 255)
+
+
+# Colors of the filled KDE bands, as plt.contourf picks them: each band takes the colormap value at its
+# midpoint, normalized between the lowest and highest level. Returns (n_bands, 3) BGR uint8.
+def band_colors(levels, cmap=cm.bone):
+    levels = np.asarray(levels, dtype=float)
+    span = levels[-1] - levels[0]
+    midpoints = 0.5 * (levels[:-1] + levels[1:])
+    positions = (midpoints - levels[0]) / span if span > 0 else np.full(midpoints.shape, 0.5)
+    rgb = (cmap(positions)[:, :3] * 255).round().astype(np.uint8)
+    return rgb[:, ::-1]
+
+
+# Filled-contour image of a KDE grid: every pixel takes the color of the band between two levels it falls in.
+# Row 0 of z is the top of the image, matching the inverted y axis of the former pyplot figure.
+def kde_image(z, levels, cmap=cm.bone):
+    levels = np.asarray(levels, dtype=float)
+    bands = np.searchsorted(levels[1:-1], z, side='right')
+    image = band_colors(levels, cmap)[bands]
+    image[(z < levels[0]) | (z > levels[-1])] = BACKGROUND
+    return image
+
+
+# Scatter image of the CNO centroids on a white canvas of the image size
+def spatial_image(points, shape, radius=SCATTER_RADIUS, color=SCATTER_COLOR):
+    image = np.full((shape[0], shape[1], 3), BACKGROUND, dtype=np.uint8)
+    for x, y in np.rint(np.asarray(points)).astype(int):
+        cv2.circle(image, (int(x), int(y)), radius, color, -1, cv2.LINE_AA)
+    return image
+
+
+# Render and save the KDE figure of one image
+def save_kde_figure(path, z, levels):
+    cv2.imwrite(path, kde_image(z, levels))
+
+
+# Render and save the spatial distribution figure of one image
+def save_spatial_figure(path, points, shape):
+    cv2.imwrite(path, spatial_image(points, shape))
+
+
+# Draw all bounding boxes onto an image in one call (same pixels as one cv2.rectangle per box)
+def draw_boxes(image, corners, color=(0, 255, 0)):
+    outlines = corners[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+    cv2.polylines(image, list(outlines), True, color, 1)
+    return image
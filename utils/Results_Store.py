@@ -0,0 +1,178 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import csv
+import numpy as np
+import pandas as pd
+from urllib.parse import quote
+from utils.Spatial_Analysis import LAYER_COUNT
+from utils.Summary_Metrics import METRIC_COLUMNS, summary_metrics
+
+# pyarrow is optional: without it results are only written as CSV
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+# Study-level Parquet dataset, next to the analysed folders. The leading dot keeps it out of the folder listing.
+DEFAULT_DATASET_DIR = '.results'
+DATASET_FILE = 'results.parquet'
+PARTITION_KEYS = ('folder', 'model', 'conf')
+LAYER_KINDS = ('Area', 'CNO', 'Density')
+
+if pa is not None:
+    SCALAR_TYPES = {'File': pa.string(), 'Country': pa.string(), 'Group': pa.string(), 'No.': pa.int64(),
+                    'TLSS': pa.int64(), 'Lesional': pa.bool_(), 'CNO': pa.int64(), 'QC': pa.string(),
+                    'QC_Conf': pa.float64(), 'AVG_Area': pa.float64(), 'AVG_Size': pa.float64(),
+                    'ECTI': pa.float64(), 'Area_Coverage': pa.float64(), 'Pass': pa.bool_()}
+    LAYER_TYPES = {'Area': pa.list_(pa.int64()), 'CNO': pa.list_(pa.float64()), 'Density': pa.list_(pa.float64())}
+
+
+# Per-image results of one folder as named columns. The folder fields (country, group, number, TLSS, lesional) are
+# repeated for every image; 'Layer_Area', 'Layer_CNO' and 'Layer_Density' hold one LAYER_COUNT array per image.
+# AVG_Area holds the total area and AVG_Size the average area, as in the CSV files written so far.
+# The summary metrics (ECTI, Area_Coverage, Pass) are computed here once, so readers do not derive them again.
+def folder_results(file_list, folder_fields, cno, total_area, avg_area, layer_area, layer_cno, layer_density,
+                   qc=None, qc_conf=None):
+    n = len(file_list)
+    country, group, number, tlss, lesional = folder_fields
+    results = {'File': list(file_list), 'Country': [country] * n, 'Group': [group] * n, 'No.': [number] * n,
+               'TLSS': [tlss] * n, 'Lesional': [lesional] * n, 'CNO': list(cno)}
+    if qc is not None:
+        results['QC'] = list(qc)
+        results['QC_Conf'] = list(qc_conf)
+    results['Layer_Area'] = list(layer_area)
+    results['Layer_CNO'] = list(layer_cno)
+    results['Layer_Density'] = list(layer_density)
+    results['AVG_Area'] = list(total_area)
+    results['AVG_Size'] = list(avg_area)
+    metrics = summary_metrics(cno, layer_area, layer_density)
+    for name in METRIC_COLUMNS:
+        results[name] = metrics[name].tolist()
+    return results
+
+
+# Column names of the results CSV, with one column per layer of each layer kind.
+# The summary metric columns come last, so the columns of earlier CSV files keep their positions.
+def csv_header(qc=False):
+    header = ['File', 'Country', 'Group', 'No.', 'TLSS', 'Lesional', 'CNO']
+    if qc:
+        header += ['QC', 'QC_Conf']
+    for kind in LAYER_KINDS:
+        header += ['Layer_{}_{}'.format(kind, i) for i in range(LAYER_COUNT)]
+    return header + ['AVG_Area', 'AVG_Size'] + list(METRIC_COLUMNS)
+
+
+# Write folder_results() as the 87-column (89 with QC) results CSV: the 84 (86) columns of the earlier files, then
+# the summary metrics
+def write_csv(path, results):
+    qc = 'QC' in results
+    header = csv_header(qc)
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for i in range(len(results['File'])):
+            row = wide_row({name: values[i] for name, values in results.items()})
+            writer.writerow([row[name] for name in header])
+
+
+# Results of one image in the CSV column layout, with the layer arrays expanded to Layer_<kind>_<i> values.
+# Any subset of the folder_results() columns may be given, e.g. the per-image results streamed during an analysis.
+def wide_row(values):
+    row = {}
+    for name, value in values.items():
+        if name.startswith('Layer_'):
+            row.update(('{}_{}'.format(name, i), v) for i, v in enumerate(value[:LAYER_COUNT]))
+        else:
+            row[name] = value
+    return row
+
+
+# Directory of the dataset partition holding the results of one folder, model and confidence threshold
+def partition_path(dataset_dir, folder, model, conf):
+    return os.path.join(dataset_dir, *('{}={}'.format(key, quote(str(value), safe=''))
+                                       for key, value in zip(PARTITION_KEYS, (folder, model, conf))))
+
+
+# Layer array of one image as a Parquet list; images without KDE layers (all NaN) get a null list
+def _layer_value(values, integer):
+    values = np.asarray(values, dtype=np.float64)
+    if np.isnan(values).all():
+        return None
+    return [int(v) for v in values] if integer else [float(v) for v in values]
+
+
+def _scalar_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+# Write folder_results() to the Parquet dataset, replacing the earlier results of the same folder/model/conf.
+# Returns the file written, or None when pyarrow is not installed.
+def write_parquet(dataset_dir, results, folder, model, conf):
+    if pa is None:
+        print("pyarrow is not installed, results are only written as CSV")
+        return None
+
+    columns = {}
+    for name, values in results.items():
+        if name.startswith('Layer_'):
+            kind = name[len('Layer_'):]
+            columns[name] = pa.array([_layer_value(v, kind == 'Area') for v in values], type=LAYER_TYPES[kind])
+        else:
+            columns[name] = pa.array([_scalar_value(v) for v in values], type=SCALAR_TYPES[name])
+    table = pa.table(columns)
+
+    directory = partition_path(dataset_dir, folder, model, conf)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, DATASET_FILE)
+    tmp_path = os.path.join(directory, '.' + DATASET_FILE + '.tmp')  # Hidden files are skipped by dataset scans
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+# Expand the layer list columns of a results table into the Layer_<kind>_<i> columns of the CSV layout
+# (float columns, NaN for images without layers, like pandas reads the CSV)
+def _wide_frame(table):
+    frame = table.to_pandas()
+    for kind in LAYER_KINDS:
+        name = 'Layer_' + kind
+        layers = np.full((len(frame), LAYER_COUNT), np.nan)
+        for i, values in enumerate(frame[name]):
+            if values is not None:
+                layers[i] = values
+        layer_columns = pd.DataFrame(layers, columns=['Layer_{}_{}'.format(kind, j) for j in range(LAYER_COUNT)],
+                                     index=frame.index)
+        frame = pd.concat([frame.drop(columns=name), layer_columns], axis=1)
+    # Results written before the summary metrics were stored do not have their columns
+    columns = [name for name in csv_header('QC' in frame) if name in frame] + [key for key in PARTITION_KEYS
+                                                                               if key in frame]
+    return frame[columns]
+
+
+# Load results from the Parquet dataset as a pandas DataFrame. Any of folder, model and conf narrows the scan to
+# the matching partitions; with all three only one file is read. wide=True returns the CSV column layout, otherwise
+# the layer arrays stay list columns. Returns None when pyarrow is missing or nothing matches.
+def load_results(dataset_dir, folder=None, model=None, conf=None, wide=True):
+    if pa is None or not os.path.isdir(dataset_dir):
+        return None
+
+    if folder is not None and model is not None and conf is not None:
+        path = os.path.join(partition_path(dataset_dir, folder, model, conf), DATASET_FILE)
+        if not os.path.isfile(path):
+            return None
+        table = pq.read_table(path)
+    else:
+        dataset = ds.dataset(dataset_dir, format='parquet', partitioning='hive')
+        condition = None
+        for key, value in zip(PARTITION_KEYS, (folder, model, conf)):
+            if value is not None:
+                term = ds.field(key) == value
+                condition = term if condition is None else condition & term
+        table = dataset.to_table(filter=condition)
+        if table.num_rows == 0:
+            return None
+
+    return _wide_frame(table) if wide else table.to_pandas()
@@ -0,0 +1,60 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import glob
+from collections import namedtuple
+
+# One AFM scan found in the source tree
+ScanEntry = namedtuple('ScanEntry', ['path', 'file_type', 'size', 'mtime'])
+
+SKIPPED_DIRS = ('CNO_Detection',)  # Output directories written by the pipeline, never containing scans
+
+
+# Return the input type of a file name ("bcr" or "nid"), or None when it is not an AFM scan
+def scan_file_type(name):
+    if name[0:2] == "._":
+        return None
+    lower = name.lower()
+    if lower.endswith('_trace.bcr') or lower.endswith('_retrace.bcr'):
+        return "bcr"
+    if lower[-3:] == 'nid':
+        return "nid"
+    return None
+
+
+# Walk the source tree once with os.scandir and group the AFM scans by the name of the directory holding them.
+# Returns {folder name: [ScanEntry, ...]} with each list sorted by path, so a folder's files can be looked up
+# directly instead of re-walking the whole tree for every folder.
+def scan_source_tree(root):
+    manifest = {}
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as error:
+            print("Cannot scan directory", directory, error)
+            continue
+
+        folder = os.path.basename(directory)
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink() and entry.name not in SKIPPED_DIRS:
+                        pending.append(entry.path)
+                    continue
+
+                file_type = scan_file_type(entry.name)
+                if file_type is None:
+                    continue
+                stat = entry.stat()
+                manifest.setdefault(folder, []).append(ScanEntry(entry.path, file_type, stat.st_size, stat.st_mtime))
+
+    for files in manifest.values():
+        files.sort()
+    return manifest
+
+
+# Sorted names of the entries directly under the study root, one folder per subject (hidden entries are skipped)
+def list_study_folders(root):
+    return sorted(path.split(os.sep)[-1] for path in glob.glob(root + os.sep + '*'))
@@ -0,0 +1,37 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import numpy as np
+from utils.Spatial_Analysis import LAYER_COUNT
+
+# Per-image summary metrics derived from the KDE layers
+ECTI_LAYERS = (16, 17, 18)  # ECTI is the mean density of these layers
+COVERAGE_LAYERS = (1, 2, 3, 4, 5)  # Area coverage is the mean area of these layers, relative to the image
+IMAGE_PIXELS = 512 * 512
+MIN_CNO = 60  # An image passes with at least MIN_CNO detected CNOs...
+MIN_COVERAGE = 90  # ...and an area coverage of at least MIN_COVERAGE %
+METRIC_COLUMNS = ('ECTI', 'Area_Coverage', 'Pass')
+
+
+# ECTI, area coverage (%) and pass flag of every image, computed for all images at once.
+# cno holds one CNO count per image, layer_area and layer_density one layer array per image (NaN for images without
+# KDE layers, whose ECTI and coverage are NaN and which never pass). Values are rounded as they are displayed.
+def summary_metrics(cno, layer_area, layer_density):
+    cno = np.asarray(cno, dtype=np.float64).reshape(-1)
+    layer_area = np.asarray(layer_area, dtype=np.float64).reshape(len(cno), LAYER_COUNT)
+    layer_density = np.asarray(layer_density, dtype=np.float64).reshape(len(cno), LAYER_COUNT)
+
+    ecti = np.round(layer_density[:, ECTI_LAYERS].sum(axis=1) / len(ECTI_LAYERS), 4)
+    coverage = np.round(layer_area[:, COVERAGE_LAYERS].sum(axis=1) * 100 / (len(COVERAGE_LAYERS) * IMAGE_PIXELS), 2)
+    passed = (cno >= MIN_CNO) & (coverage >= MIN_COVERAGE)
+    return {'ECTI': ecti, 'Area_Coverage': coverage, 'Pass': passed}
+
+
+# Add the summary metric columns to results in the CSV column layout (Layer_<kind>_<i> columns) that do not have them
+# for every row yet, e.g. results written before the metrics were stored or the rows streamed during an analysis
+def add_summary_metrics(df):
+    if all(name in df for name in METRIC_COLUMNS) and df['Pass'].notna().all():
+        return df
+    metrics = summary_metrics(df['CNO'].to_numpy(),
+                              df[['Layer_Area_{}'.format(i) for i in range(LAYER_COUNT)]].to_numpy(),
+                              df[['Layer_Density_{}'.format(i) for i in range(LAYER_COUNT)]].to_numpy())
+    return df.assign(**metrics)
@@ -0,0 +1,99 @@
+# Copyright 2024 Jen-Hung Wang, IDUN Section, Department of Health Technology, Technical University of Denmark (DTU)
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+DEFAULT_MAX_ITEMS = 48  # Decoded images kept, about 36 MB at 512 x 512 RGB
+PREFETCH_RADIUS = 2  # Images on each side of the shown one that are decoded ahead
+
+
+# Cache key of an image file, so images rewritten on disk (e.g. figures rendered again) are decoded again.
+# Returns None when the file does not exist.
+def image_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+# Decode an image file at display size
+def decode_image(path, size):
+    with Image.open(path) as image:
+        image = image.convert('RGB')
+    if image.size != tuple(size):
+        image = image.resize(size, Image.BILINEAR)
+    return image
+
+
+# Images decoded at display size, kept in a bounded LRU. prefetch() decodes the images about to be shown on a
+# background thread, so navigating only swaps images that are already in memory. Missing and undecodable files are
+# never cached, since they may appear or be completed later (e.g. while a folder is still being analysed).
+class ThumbnailCache:
+    def __init__(self, size, max_items=DEFAULT_MAX_ITEMS):
+        self.size = tuple(size)
+        self.max_items = max(1, int(max_items))
+        self.images = OrderedDict()
+        self.pending = {}
+        self.lock = threading.RLock()  # Done callbacks of cancelled or finished futures run inside prefetch()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+
+    def _store(self, key, image):
+        with self.lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            while len(self.images) > self.max_items:
+                self.images.popitem(last=False)
+
+    def _load(self, key):
+        image = decode_image(key[0], self.size)
+        self._store(key, image)
+        return image
+
+    # Decoded image of a file, or None when it does not exist or cannot be decoded (e.g. a figure still being written)
+    def get(self, path):
+        key = image_key(path)
+        if key is None:
+            return None
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return image
+            future = self.pending.get(key)
+        try:
+            if future is not None and not future.cancel():
+                return future.result()  # Already being decoded by a prefetch
+            return self._load(key)
+        except OSError:
+            return None  # Nothing is stored, so the file is decoded again the next time it is shown
+
+    # Decode files in the background, in the given order. Requests of an earlier call that have not started yet
+    # are dropped, so fast navigation does not queue up images that are no longer needed.
+    def prefetch(self, paths):
+        keys = [key for key in map(image_key, paths) if key is not None]
+        with self.lock:
+            for key, future in list(self.pending.items()):
+                if key not in keys:
+                    future.cancel()
+            for key in keys:
+                if key in self.images or key in self.pending:
+                    continue
+                future = self.executor.submit(self._load, key)
+                self.pending[key] = future
+                future.add_done_callback(lambda done, key=key: self._finished(key, done))
+
+    def _finished(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -8,7 +8,10 @@ import gradio as gr
 import numpy as np
 import math
 from pathlib import Path
-from ultralytics import ASSETS, YOLO
+from utils.CNO_Detector import warmup_detectors, box_geometry
+from utils.Rendering import draw_boxes
+from utils.Inference_Service import InferenceService, ServiceBusy, TooManyImages
+from config.global_settings import import_config_dict
 
 DIR_NAME = Path(os.path.dirname(__file__))
 DETECTION_MODEL_n = os.path.join(DIR_NAME, 'models', 'YOLOv8-N_CNO_Detection.pt')
@@ -16,6 +19,16 @@ DETECTION_MODEL_s = os.path.join(DIR_NAME, 'models', 'YOLOv8-S_CNO_Detection.pt'
 DETECTION_MODEL_m = os.path.join(DIR_NAME, 'models', 'YOLOv8-M_CNO_Detection.pt')
 DETECTION_MODEL_l = os.path.join(DIR_NAME, 'models', 'YOLOv8-L_CNO_Detection.pt')
 DETECTION_MODEL_x = os.path.join(DIR_NAME, 'models', 'YOLOv8-X_CNO_Detection.pt')
+DETECTION_MODELS = {'YOLOv8-N': DETECTION_MODEL_n, 'YOLOv8-S': DETECTION_MODEL_s, 'YOLOv8-M': DETECTION_MODEL_m,
+                    'YOLOv8-L': DETECTION_MODEL_l, 'YOLOv8-X': DETECTION_MODEL_x}
+WARMUP_MODELS = ['YOLOv8-M']  # Variants loaded at startup so the first request only pays for inference
+
+# Detection requests of all users go through one service, which batches them and limits concurrent inference
+SERVING = import_config_dict()['SERVING']
+inference_service = InferenceService(DETECTION_MODELS, max_batch=SERVING['max_batch'],
+                                     batch_wait=SERVING['batch_wait_ms'] / 1000,
+                                     concurrency=SERVING['concurrency_limit'], max_queued=SERVING['max_queued'],
+                                     predict_args={'imgsz': 512, 'max_det': 1200})
 
 
 def predict_image(name, model, img, conf_threshold, iou_threshold):
@@ -25,26 +38,22 @@ def predict_image(name, model, img, conf_threshold, iou_threshold):
     if name == "":
         gr.Warning("Name is empty")
 
-    if model == 'YOLOv8-N':
-        CNO_model = YOLO(DETECTION_MODEL_n)
-    elif model == 'YOLOv8-S':
-        CNO_model = YOLO(DETECTION_MODEL_s)
-    elif model == 'YOLOv8-M':
-        CNO_model = YOLO(DETECTION_MODEL_m)
-    elif model == 'YOLOv8-L':
-        CNO_model = YOLO(DETECTION_MODEL_l)
-    else:
-        CNO_model = YOLO(DETECTION_MODEL_x)
-
-    results = CNO_model.predict(
-        source=img,
-        conf=conf_threshold,
-        iou=iou_threshold,
-        show_labels=False,
-        show_conf=False,
-        imgsz=512,
-        max_det=1200
-    )
+    if not img:
+        raise gr.Error("No images uploaded")
+
+    # Decoded here, so uploads are read in parallel while the inference service runs YOLO
+    images = [cv2.imread(path) for path in img]
+    if any(image is None for image in images):
+        raise gr.Error("Could not read image(s): {}".format(
+            ", ".join(os.path.basename(path) for path, image in zip(img, images) if image is None)))
+
+    try:
+        results = inference_service.submit(model if model in DETECTION_MODELS else 'YOLOv8-X', images,
+                                           conf_threshold, iou_threshold).result()
+    except TooManyImages:
+        raise gr.Error("Too many images, please upload at most {} at a time".format(inference_service.max_queued))
+    except ServiceBusy:
+        raise gr.Error("The server is busy, please try again in a moment")
 
     cno_count = []
     cno_image = []
@@ -54,24 +63,9 @@ def predict_image(name, model, img, conf_threshold, iou_threshold):
 
     for idx, result in enumerate(results):
         cno = len(result.boxes)
-        cno_coor = np.empty([cno, 2], dtype=int)
         file_label = img[idx].split(os.sep)[-1]
-        for j in range(cno):
-            # w = r.boxes.xywh[j][2]
-            # h = r.boxes.xywh[j][3]
-            # area = (math.pi * w * h / 4) * 20 * 20 / (512 * 512)
-            # total_area += area
-            # bbox_img = r.orig_img
-            x = round(result.boxes.xywh[j][0].item())
-            y = round(result.boxes.xywh[j][1].item())
-
-            x1 = round(result.boxes.xyxy[j][0].item())
-            y1 = round(result.boxes.xyxy[j][1].item())
-            x2 = round(result.boxes.xyxy[j][2].item())
-            y2 = round(result.boxes.xyxy[j][3].item())
-
-            cno_coor[j] = [x, y]
-            cv2.rectangle(result.orig_img, (x1, y1), (x2, y2), (0, 255, 0), 1)
+        cno_coor, bbox_xyxy, _ = box_geometry(result.boxes)
+        draw_boxes(result.orig_img, bbox_xyxy)
         im_array = result.orig_img
         cno_image.append([Image.fromarray(im_array[..., ::-1]), file_label])
         cno_count.append(cno)
@@ -148,7 +142,8 @@ with gr.Blocks(title="AFM AI Analysis", theme="default") as app:
     analyze_btn.click(
         fn=predict_image,
         inputs=[name_textbox, model_radio, input_files, conf_slider, iou_slider],
-        outputs=[analysis_results, cno_gallery]
+        outputs=[analysis_results, cno_gallery],
+        concurrency_limit=SERVING['handler_concurrency']  # Waiting handlers let uploads share inference batches
     )
 
     clear_btn.click(reset, outputs=[name_textbox, gender_radio, age_slider, fitzpatrick, history, model_radio,
@@ -159,5 +154,7 @@ with gr.Blocks(title="AFM AI Analysis", theme="default") as app:
 
 if __name__ == '__main__':
     # iface.launch()
+    warmup_detectors([DETECTION_MODELS[model] for model in WARMUP_MODELS])
+    app.queue(max_size=SERVING['queue_size'])
     app.launch()
 